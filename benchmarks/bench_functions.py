@@ -0,0 +1,77 @@
+"""Compare the columnar aggregate functions against per-object generators
+Run with: python benchmarks/bench_functions.py [count]
+"""
+import sys
+
+import numpy as np
+from common import bench, make_aggregate_response
+
+from metricq_grafana.functions import (
+    AvgFunction,
+    CountFunction,
+    MaxFunction,
+    MinFunction,
+)
+from metricq_grafana.history_data import HistoryData
+from metricq_grafana.target import Target
+
+
+def reference(response, attribute):
+    """The previous generator-based implementation"""
+    for timeaggregate in response.aggregates():
+        if timeaggregate.count != 0:
+            yield timeaggregate.timestamp, getattr(timeaggregate, attribute)
+        else:
+            yield timeaggregate.timestamp, None
+
+
+FUNCTIONS = {
+    "mean": AvgFunction(),
+    "minimum": MinFunction(),
+    "maximum": MaxFunction(),
+    "count": CountFunction(),
+}
+
+
+def check(response):
+    data = HistoryData.from_response(response)
+    for attribute, function in FUNCTIONS.items():
+        timestamps, values = function.transform_data(data)
+        expected = list(reference(response, attribute))
+        assert timestamps.tolist() == [t.posix_ns for t, _ in expected]
+        expected_values = np.array(
+            [np.nan if v is None else v for _, v in expected], dtype=np.float64
+        )
+        np.testing.assert_array_equal(values, expected_values)
+
+
+def main(count):
+    response = make_aggregate_response(count)
+    check(response)
+
+    def generators():
+        for attribute in ["mean", "minimum", "maximum"]:
+            list(reference(response, attribute))
+
+    def columnar():
+        data = HistoryData.from_response(response)
+        for function in [AvgFunction(), MinFunction(), MaxFunction()]:
+            function.transform_data(data)
+
+    print(f"avg+min+max over {count} aggregates")
+    before = bench("generators", generators)
+    after = bench("columnar", columnar)
+    print(f"speedup: {before / after:.1f}x")
+
+    def convert(functions):
+        target = Target("benchmark", functions=functions)
+        data = HistoryData.from_response(response)
+        return lambda: target._convert_response(data, 0.0, {})
+
+    print(f"Target conversion including output of {count} aggregates")
+    bench("avg", convert([AvgFunction()]))
+    bench("avg+min+max", convert([AvgFunction(), MinFunction(), MaxFunction()]))
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10_000)
@@ -0,0 +1,103 @@
+"""Compare MovingAverageFunction against the previous two-pointer implementation
+The results are compared in tests/test_functions.py.
+Run with: python benchmarks/bench_moving_average.py [count]
+"""
+import sys
+
+from common import bench, make_aggregate_response
+from metricq.types import Timedelta
+
+from metricq_grafana.functions import MovingAverageFunction
+from metricq_grafana.history_data import HistoryData
+
+
+def _calculate_interval_durations(response_aggregates):
+    yield Timedelta(0)
+    for previous_ta, current_ta in zip(response_aggregates, response_aggregates[1:]):
+        duration = current_ta.timestamp - previous_ta.timestamp
+        assert duration > Timedelta(0)
+        yield duration
+
+
+def reference(response, interval):
+    """The previous implementation, based on a moving window over TimeAggregates"""
+    response_aggregates = list(response.aggregates(convert=True))
+
+    if len(response_aggregates) == 0:
+        return
+
+    ma_integral_ns = 0
+    ma_active_time = Timedelta(0)
+    ma_begin_index = 1
+    ma_begin_time = response_aggregates[0].timestamp
+    ma_end_index = 1
+    ma_end_time = response_aggregates[0].timestamp
+
+    interval_durations = list(_calculate_interval_durations(response_aggregates))
+
+    for timeaggregate, current_interval_duration in zip(
+        response_aggregates, interval_durations
+    ):
+        outside_duration = max(Timedelta(0), interval - current_interval_duration)
+        seek_begin_time = (
+            timeaggregate.timestamp - current_interval_duration - outside_duration / 2
+        )
+        seek_end_time = timeaggregate.timestamp + outside_duration / 2
+
+        while ma_begin_time < seek_begin_time:
+            next_step_time = min(
+                response_aggregates[ma_begin_index].timestamp, seek_begin_time
+            )
+            step_duration = next_step_time - ma_begin_time
+            scale = step_duration.ns / interval_durations[ma_begin_index].ns
+            ma_active_time -= response_aggregates[ma_begin_index].active_time * scale
+            ma_integral_ns -= response_aggregates[ma_begin_index].integral_ns * scale
+            ma_begin_time = next_step_time
+            if ma_begin_time == response_aggregates[ma_begin_index].timestamp:
+                ma_begin_index += 1
+
+        while ma_end_time < seek_end_time and ma_end_index < len(response_aggregates):
+            next_step_time = min(
+                response_aggregates[ma_end_index].timestamp, seek_end_time
+            )
+            step_duration = next_step_time - ma_end_time
+            scale = step_duration.ns / interval_durations[ma_end_index].ns
+            ma_active_time += response_aggregates[ma_end_index].active_time * scale
+            ma_integral_ns += response_aggregates[ma_end_index].integral_ns * scale
+            ma_end_time = next_step_time
+            if ma_end_time == response_aggregates[ma_end_index].timestamp:
+                ma_end_index += 1
+
+        if seek_begin_time != ma_begin_time or seek_end_time != ma_end_time:
+            continue
+        if ma_active_time.ns == 0:
+            continue
+
+        yield timeaggregate.timestamp, ma_integral_ns / ma_active_time.ns, ma_active_time
+
+
+def main(count):
+    response = make_aggregate_response(count)
+    interval = Timedelta.from_s(60)
+
+    print(f"sma over {count} aggregates")
+    before = bench("reference", lambda: list(reference(response, interval)), 1)
+    after = bench(
+        "prefix sums",
+        lambda: MovingAverageFunction(interval).transform_data(
+            HistoryData.from_response(response)
+        ),
+        1,
+    )
+    print(f"speedup: {before / after:.1f}x")
+
+    data = HistoryData.from_response(response)
+    data.aggregates()
+    bench(
+        "prefix sums, without decoding",
+        lambda: MovingAverageFunction(interval).transform_data(data),
+    )
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100_000)
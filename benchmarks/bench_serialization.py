@@ -0,0 +1,42 @@
+"""Compare JSON serialization of /query responses
+The previous path built lists of tuples and serialized them with the json module.
+Run with: python benchmarks/bench_serialization.py [count]
+"""
+import json
+import sys
+
+from common import bench, make_aggregate_response
+
+from metricq_grafana.functions import AvgFunction, MaxFunction, MinFunction
+from metricq_grafana.history_data import HistoryData
+from metricq_grafana.serialization import dumps_orjson, dumps_stdlib, orjson
+from metricq_grafana.target import Target
+
+
+def main(count):
+    target = Target(
+        "benchmark", functions=[AvgFunction(), MinFunction(), MaxFunction()]
+    )
+    result = target._convert_response(
+        HistoryData.from_response(make_aggregate_response(count)), 0.0, {}
+    )
+    previous = [
+        dict(series, datapoints=list(series["datapoints"])) for series in result
+    ]
+    expected = json.dumps(previous).encode()
+    size = len(expected)
+
+    print(f"avg+min+max over {count} aggregates, {size / 1e6:.1f} MB")
+    candidates = [("json, tuples", lambda: json.dumps(previous).encode())]
+    candidates.append(("json, columns", lambda: dumps_stdlib(result)))
+    if orjson is not None:
+        candidates.append(("orjson, columns", lambda: dumps_orjson(result)))
+
+    for name, dumps in candidates:
+        assert json.loads(dumps()) == json.loads(expected)
+        duration = bench(name, dumps)
+        print(f"{'':<40} {size / duration / 1e6:10.1f} MB/s")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100_000)
@@ -0,0 +1,43 @@
+"""Helpers to create synthetic history responses for the benchmarks"""
+import timeit
+
+import numpy as np
+from metricq.history_client import HistoryResponse
+from metricq.history_pb2 import HistoryResponse as HistoryResponseProto
+
+START_NS = 1_600_000_000 * 10**9
+
+
+def make_aggregate_response(count, interval_ns=10**9, seed=0, empty_ratio=0.05):
+    """Aggregates with jittered interval lengths and some empty intervals"""
+    rng = np.random.default_rng(seed)
+    proto = HistoryResponseProto()
+    durations = rng.integers(interval_ns // 2, interval_ns * 2, size=count)
+    proto.time_delta.extend([START_NS] + durations[1:].tolist())
+    for duration in durations.tolist():
+        aggregate = proto.aggregate.add()
+        if rng.random() < empty_ratio:
+            continue
+        values = rng.normal(100, 20, size=rng.integers(1, 20))
+        aggregate.minimum = values.min()
+        aggregate.maximum = values.max()
+        aggregate.sum = values.sum()
+        aggregate.count = len(values)
+        aggregate.active_time = duration
+        aggregate.integral = values.mean() * duration
+    return HistoryResponse(proto, request_duration=0.0)
+
+
+def make_value_response(count, interval_ns=10**9, seed=0):
+    rng = np.random.default_rng(seed)
+    proto = HistoryResponseProto()
+    durations = rng.integers(interval_ns // 2, interval_ns * 2, size=count)
+    proto.time_delta.extend([START_NS] + durations[1:].tolist())
+    proto.value.extend(rng.normal(100, 20, size=count).tolist())
+    return HistoryResponse(proto, request_duration=0.0)
+
+
+def bench(name, function, number=10):
+    duration = min(timeit.repeat(function, number=number, repeat=3)) / number
+    print(f"{name:<40} {duration * 1e3:10.3f} ms")
+    return duration
@@ -5,21 +5,69 @@ import operator
 import time
 
 from metricq import get_logger
-from metricq.history_client import HistoryRequestType, HistoryResponseType
+from metricq.history_client import HistoryResponseType
 from metricq.types import Timestamp
 
+from .decimation import get_decimator
 from .functions import parse_functions
-from .target import Target
+from .history_data import HistoryData
+from .request_context import for_target
+from .resolution import plan_metric_resolution
+from .target import Target, TargetGroup
 from .utils import unpack_metric
 
 logger = get_logger(__name__)
 timer = time.monotonic
 
+# /analyze reduces the timeline that /query would show with this many points,
+# unless the request contains maxDataPoints like a query
+ANALYZE_MAX_DATA_POINTS = 1000
+
 
 async def get_history_data(app, request):
+    targets, time_range = await _parse_history_request(app, request)
+    groups = _group_by_metric(targets)
+    responses = await asyncio.gather(
+        *[
+            for_target(
+                metric,
+                TargetGroup([targets[index] for index in indexes]).get_responses(
+                    app, *time_range, serialize=True
+                ),
+            )
+            for metric, indexes in groups.items()
+        ]
+    )
+    # Grafana relies on the results being in the order of the targets
+    results = [None] * len(targets)
+    for indexes, group_responses in zip(groups.values(), responses):
+        for index, series in zip(indexes, group_responses):
+            results[index] = series
+    rv = functools.reduce(operator.iconcat, results, [])
+
+    return rv
+
+
+async def prepare_history_data(app, request):
+    """Parse a query and return metric -> awaitable list of series"""
+    targets, time_range = await _parse_history_request(app, request)
+    return {
+        metric: for_target(
+            metric,
+            TargetGroup([targets[index] for index in indexes]).get_response(
+                app, *time_range, serialize=True
+            ),
+        )
+        for metric, indexes in _group_by_metric(targets).items()
+    }
+
+
+async def _parse_history_request(app, request):
+    """The targets of a query and the start, end and max points of its range"""
     targets = []
     for target_dict in request["targets"]:
         metrics = await unpack_metric(app, target_dict["metric"])
+        decimator = get_decimator(target_dict.get("decimation", "lttb"))
 
         for metric in metrics:
             targets.append(
@@ -33,6 +81,8 @@ async def get_history_data(app, request):
                                 "scaling_factor", "1")
                         )
                     ),
+                    decimator=decimator,
+                    max_data_points=request["maxDataPoints"],
                 )
             )
 
@@ -42,16 +92,16 @@ async def get_history_data(app, request):
     #    intervalMs is very coarse grained
     #    maxDataPoints is not really the number of pixels, usually less
     # interval = Timedelta.from_ms(request["intervalMs"])
-    interval = ((end_time - start_time) / request["maxDataPoints"]) * 2
-    results = await asyncio.gather(
-        *[
-            target.get_response(app, start_time, end_time, interval)
-            for target in targets
-        ]
-    )
-    rv = functools.reduce(operator.iconcat, results, [])
+    max_points = request["maxDataPoints"] / 2
+    return targets, (start_time, end_time, max_points)
 
-    return rv
+
+def _group_by_metric(targets):
+    """metric -> indexes of the targets of that metric, each requested only once"""
+    groups = {}
+    for index, target in enumerate(targets):
+        groups.setdefault(target.metric, []).append(index)
+    return groups
 
 
 async def get_analyze_data(app, request):
@@ -61,21 +111,40 @@ async def get_analyze_data(app, request):
 
     start_time = Timestamp.from_iso8601(request["range"]["from"])
     end_time = Timestamp.from_iso8601(request["range"]["to"])
+    max_points = request.get("maxDataPoints", ANALYZE_MAX_DATA_POINTS) / 2
     results = await asyncio.gather(
-        *[get_analyze_response(app, metric, start_time, end_time) for metric in targets]
+        *[
+            get_analyze_response(app, metric, start_time, end_time, max_points)
+            for metric in targets
+        ]
     )
 
     return results
 
 
-async def get_analyze_response(app, metric, start_time, end_time):
+async def get_analyze_response(app, metric, start_time, end_time, max_points):
     perf_begin_ns = time.perf_counter_ns()
-    aggregate = await app["history_client"].history_aggregate(
-        metric,
-        start_time,
-        end_time,
-        timeout=30,
-    )
+    aggregate = None
+    if "rollups" in app:
+        aggregate = await app["rollups"].aggregate(metric, start_time, end_time)
+    if aggregate is None:
+        # Usually in the history cache already, if the metric is also displayed
+        resolution = plan_metric_resolution(
+            app["metric_catalog"], metric, start_time, end_time, max_points
+        )
+        data = await app["history_cache"].history_data_request(
+            metric,
+            start_time,
+            end_time,
+            resolution.interval,
+            request_type=resolution.request_type,
+        )
+        if data is not None:
+            aggregate = data.aggregate(start_time.posix_ns, end_time.posix_ns)
+    if aggregate is None:
+        aggregate = await app["history_client"].history_aggregate(
+            metric, start_time, end_time
+        )
     perf_end_ns = time.perf_counter_ns()
 
     if aggregate is None:
@@ -116,14 +185,16 @@ async def get_metric_list(app, search_query, metadata=False, limit=None):
         elif limit is None:
             get_metrics_args["limit"] = 100
 
-    result = await app["history_client"].get_metrics(**get_metrics_args)
-    if result:
-        if isinstance(result, list):
-            rv = sorted(result)
+    rv = _search_catalog(app["metric_catalog"], **get_metrics_args)
+    if rv is None:
+        result = await app["history_client"].get_metrics(**get_metrics_args)
+        if result:
+            if isinstance(result, list):
+                rv = sorted(result)
+            else:
+                rv = result
         else:
-            rv = result
-    else:
-        rv = []
+            rv = []
     time_diff = timer() - time_begin
     logger.log(
         logging.DEBUG if time_diff < 1 else logging.INFO,
@@ -135,24 +206,47 @@ async def get_metric_list(app, search_query, metadata=False, limit=None):
     return rv
 
 
+def _search_catalog(catalog, metadata, historic, selector=None, infix=None, limit=None):
+    """Same as get_metrics of the manager for historic metrics,
+    None if the catalog can't answer it
+    """
+    if selector is not None:
+        result = catalog.match(selector, limit=limit)
+    else:
+        result = catalog.infix(infix, limit=limit)
+    if result is not None and metadata:
+        return catalog.with_metadata(result)
+    return result
+
+
 async def get_metadata(app, metric):
     time_begin = timer()
-    result = await app["history_client"].get_metrics(selector=[metric])
+    metadata = app["metric_catalog"].metadata(metric)
+    if metadata is not None:
+        return {metric: metadata}
+    metadata = await app["metadata_batcher"].get(metric)
     logger.info(
         "get_metadata for {} returned {} metrics and took {} s",
         metric,
-        len(result),
+        0 if metadata is None else 1,
         timer() - time_begin,
     )
-    if result:
-        return result
+    if metadata is not None:
+        return {metric: metadata}
     else:
         raise KeyError(f"Could not find any metadata for '{metric}'")
 
 
 async def get_counter_list(app, selector):
     time_begin = timer()
-    metrics = await app["history_client"].get_metrics(selector=selector, historic=True)
+    catalog = app["metric_catalog"]
+    names = catalog.match(selector)
+    if names is not None:
+        metrics = catalog.with_metadata(names)
+    else:
+        metrics = await app["history_client"].get_metrics(
+            selector=selector, historic=True
+        )
     result = []
     for metric, metadata in metrics.items():
         result.append([metric, metadata.get("description", "")])
@@ -169,12 +263,13 @@ async def get_counter_list(app, selector):
 
 async def get_counter_data(app, metric, start, stop, width):
     time_begin = timer()
-    target = Target(metric, order_time_value=True)
+    target = Target(
+        metric, order_time_value=True, decimator=get_decimator(), max_data_points=width
+    )
     start_time = Timestamp(start * 10**6)
     end_time = Timestamp(stop * 10**6)
-    interval = (end_time - start_time) / width
     results, metadata = await asyncio.gather(
-        target.get_response(app, start_time, end_time, interval),
+        target.get_response(app, start_time, end_time, width),
         target.get_metadata(app),
     )
     try:
@@ -186,9 +281,7 @@ async def get_counter_data(app, metric, start, stop, width):
             "unit": "",
         }
 
-    datapoints = [
-        datapoint for datapoint in result["datapoints"] if start <= datapoint[0] <= stop
-    ]
+    datapoints = result["datapoints"].time_range(start, stop)
 
     rv = {
         "description": metadata.get("description", ""),
@@ -206,7 +299,7 @@ async def get_counter_data(app, metric, start, stop, width):
     return rv
 
 
-async def handle_timeline_request(app, request):
+async def handle_timeline_request(app, request, columnar=False):
     metrics = []
     for metric in request["metrics"]:
         metrics.extend(await unpack_metric(app, metric))
@@ -214,11 +307,24 @@ async def handle_timeline_request(app, request):
     start_time = Timestamp.from_iso8601(request["range"]["from"])
     end_time = Timestamp.from_iso8601(request["range"]["to"])
 
-    interval = ((end_time - start_time) / request["maxDataPoints"]) * 2
+    max_points = request["maxDataPoints"] / 2
+    decimator = get_decimator(request.get("decimation", "lttb"))
 
     results = await asyncio.gather(
         *[
-            get_timeline(app, metric, start_time, end_time, interval)
+            for_target(
+                metric,
+                get_timeline(
+                    app,
+                    metric,
+                    start_time,
+                    end_time,
+                    max_points,
+                    decimator=decimator,
+                    max_data_points=request["maxDataPoints"],
+                    columnar=columnar,
+                ),
+            )
             for metric in metrics
         ]
     )
@@ -226,14 +332,29 @@ async def handle_timeline_request(app, request):
     return dict(zip(metrics, results))
 
 
-async def get_timeline(app, metric, start_time, end_time, interval):
+async def get_timeline(
+    app,
+    metric,
+    start_time,
+    end_time,
+    max_points,
+    decimator=None,
+    max_data_points=None,
+    columnar=False,
+):
+    """Aggregates or values of the metric as a list of dicts,
+    or as the columns of :class:`HistoryData` if columnar is set.
+    """
     perf_begin_ns = time.perf_counter_ns()
+    resolution = plan_metric_resolution(
+        app["metric_catalog"], metric, start_time, end_time, max_points
+    )
     response = await app["history_client"].history_data_request(
         metric,
         start_time,
         end_time,
-        interval,
-        request_type=HistoryRequestType.FLEX_TIMELINE,
+        resolution.interval,
+        request_type=resolution.request_type,
     )
     perf_end_ns = time.perf_counter_ns()
 
@@ -255,11 +376,31 @@ async def get_timeline(app, metric, start_time, end_time, interval):
     else:
         raise NotImplementedError("Received unexpected HistoryResponseType")
 
+    if columnar:
+        entries = getattr(HistoryData.from_response(response), mode)()
+    else:
+        entries = [entry.dict() for entry in getattr(response, mode)()]
+    if (
+        mode == "values"
+        and decimator is not None
+        and max_data_points is not None
+        and len(response) > max_data_points
+    ):
+        if columnar:
+            values = entries
+        else:
+            values = HistoryData.from_response(response).values()
+        selected = decimator(values.timestamp, values.value, max_data_points)
+        if columnar:
+            entries = type(entries)(*(column[selected] for column in entries))
+        else:
+            entries = [entries[index] for index in selected.tolist()]
+
     return {
         "mode": mode,
         "time_measurements": {
             "db": response.request_duration,
             "http": (perf_end_ns - perf_begin_ns) / 1e9,
         },
-        mode: [entry.dict() for entry in getattr(response, mode)()],
+        mode: entries,
     }
@@ -0,0 +1,222 @@
+"""In-process cache for history data, aligned to fixed time tiles"""
+import asyncio
+import time
+from collections import OrderedDict
+
+import numpy as np
+from metricq import get_logger
+from metricq.history_client import HistoryRequestType, HistoryResponseType
+from metricq.types import Timedelta, Timestamp
+
+from .history_data import HistoryData
+from .resolution import canonical_interval
+
+logger = get_logger(__name__)
+timer = time.monotonic
+
+# Number of intervals covered by a single tile
+TILE_INTERVALS = 256
+# Requests spanning more tiles than this bypass the cache
+MAX_TILES = 64
+# Tiles ending less than this before "now" may still receive data
+HOT_TILE_SETTLE_TIME = Timedelta.from_s(60)
+
+
+class _Tile:
+    def __init__(self, data: HistoryData, expires=None):
+        self.data = data
+        self.expires = expires
+
+    def __len__(self):
+        return len(self.data)
+
+    @property
+    def expired(self):
+        return self.expires is not None and self.expires < timer()
+
+
+class HistoryCache:
+    """LRU cache of history responses, split into tiles.
+
+    Requests are widened to tile boundaries, only the missing tiles are requested
+    from the database and the tiles are stitched back into one :class:`HistoryData`.
+    Tiles that may still receive new data ("hot" tiles) are only kept for
+    :code:`hot_ttl` seconds. After that, only the data since their last entry
+    is requested, so that refreshing dashboards cause load proportional to the
+    refresh interval instead of the range.
+    All other tiles are also written to the optional :code:`store` on disk.
+    """
+
+    def __init__(self, client, max_points=2_000_000, hot_ttl=5.0, store=None):
+        self._client = client
+        self._store = store
+        self._max_points = max_points
+        self._hot_ttl = hot_ttl
+        self._tiles = OrderedDict()
+        self._points = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.tail_refreshes = 0
+
+    async def history_data_request(
+        self,
+        metric,
+        start_time: Timestamp,
+        end_time: Timestamp,
+        interval: Timedelta,
+        request_type=HistoryRequestType.FLEX_TIMELINE,
+        timeout=60,
+    ):
+        # Requests with slightly different intervals (e.g. due to different panel
+        # widths) share the same tiles
+        bucket = canonical_interval(interval)
+        tile_duration = bucket.ns * TILE_INTERVALS
+        first_tile = start_time.posix_ns // tile_duration
+        last_tile = end_time.posix_ns // tile_duration
+
+        if self._max_points <= 0 or last_tile - first_tile >= MAX_TILES:
+            return await self._request(
+                metric, start_time, end_time, interval, request_type, timeout
+            )
+
+        hot_begin_ns = (Timestamp.now() - HOT_TILE_SETTLE_TIME).posix_ns
+        results = await asyncio.gather(
+            *[
+                self._get_tile(
+                    metric, bucket, request_type, index, hot_begin_ns, timeout
+                )
+                for index in range(first_tile, last_tile + 1)
+            ]
+        )
+        if any(tile is None for tile, _ in results):
+            return None
+
+        # Only tiles which were actually requested contribute to the duration
+        request_duration = max(
+            (tile.data.request_duration for tile, cached in results if not cached),
+            default=0.0,
+        )
+        data = HistoryData.concatenate(
+            [tile.data for tile, _ in results], request_duration
+        )
+        if data is None:
+            # The database chose different modes for different tiles
+            logger.debug("cannot stitch tiles for {}, requesting directly", metric)
+            return await self._request(
+                metric, start_time, end_time, interval, request_type, timeout
+            )
+        return data.trim(start_time.posix_ns, end_time.posix_ns)
+
+    async def _get_tile(
+        self, metric, bucket, request_type, index, hot_begin_ns, timeout
+    ):
+        key = (metric, bucket.ns, request_type, index)
+        tile = self._tiles.get(key)
+        if tile is not None and not tile.expired:
+            self._tiles.move_to_end(key)
+            self.hits += 1
+            return tile, True
+
+        tile_duration = bucket.ns * TILE_INTERVALS
+        tile_begin_ns = index * tile_duration
+        tile_end_ns = tile_begin_ns + tile_duration
+        hot = tile_end_ns > hot_begin_ns
+        if tile is None and not hot and self._store is not None:
+            data = await self._store.load(key)
+            if data is not None:
+                tile = _Tile(data)
+                self._insert(key, tile)
+                return tile, True
+
+        self.misses += 1
+        data = None
+        if tile is not None:
+            # An expired hot tile, which only lacks the most recent data
+            data = await self._request_tail(
+                metric, tile, bucket, request_type, tile_end_ns, timeout
+            )
+        if data is None:
+            data = await self._request(
+                metric,
+                Timestamp(tile_begin_ns),
+                Timestamp(tile_end_ns),
+                bucket,
+                request_type,
+                timeout,
+            )
+        if data is None:
+            return None, False
+
+        if hot:
+            tile = _Tile(data, timer() + self._hot_ttl)
+        else:
+            tile = _Tile(data)
+            if self._store is not None:
+                self._store.save(key, data)
+        self._insert(key, tile)
+        return tile, False
+
+    async def _request_tail(
+        self, metric, tile, bucket, request_type, tile_end_ns, timeout
+    ):
+        """The data of the tile updated with the data since its last entry,
+        None if the tile has to be requested completely
+        """
+        mode = tile.data.mode
+        if len(tile.data) == 0 or mode not in (
+            HistoryResponseType.AGGREGATES,
+            HistoryResponseType.VALUES,
+        ):
+            return None
+        if mode is HistoryResponseType.AGGREGATES:
+            # The few values of the tail alone must not turn into raw values
+            request_type = HistoryRequestType.AGGREGATE_TIMELINE
+
+        # The last entry within the tile may have been incomplete,
+        # so it is requested again
+        timestamps = tile.data.timestamps
+        last = np.searchsorted(timestamps, tile_end_ns, side="left") - 1
+        if last < 0:
+            return None
+        tail_begin_ns = int(timestamps[last])
+        tail = await self._request(
+            metric,
+            Timestamp(tail_begin_ns),
+            Timestamp(tile_end_ns),
+            bucket,
+            request_type,
+            timeout,
+        )
+        if tail is None or tail.mode is not mode:
+            return None
+
+        self.tail_refreshes += 1
+        head = tile.data.head(int(tail.timestamps[0]))
+        return HistoryData.concatenate([head, tail], tail.request_duration)
+
+    async def _request(
+        self, metric, start_time, end_time, interval, request_type, timeout
+    ):
+        response = await self._client.history_data_request(
+            metric,
+            start_time,
+            end_time,
+            interval,
+            timeout=timeout,
+            request_type=request_type,
+        )
+        if response is None:
+            return None
+        return HistoryData.from_response(response)
+
+    def _insert(self, key, tile):
+        previous = self._tiles.pop(key, None)
+        if previous is not None:
+            self._points -= len(previous)
+        self._tiles[key] = tile
+        self._points += len(tile)
+
+        while self._points > self._max_points and len(self._tiles) > 1:
+            _, evicted = self._tiles.popitem(last=False)
+            self._points -= len(evicted)
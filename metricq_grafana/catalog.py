@@ -0,0 +1,180 @@
+"""Module for the in-memory catalog of historic metrics"""
+import asyncio
+import bisect
+import functools
+import re
+import time
+from collections import OrderedDict, defaultdict
+from contextlib import suppress
+
+import numpy as np
+from metricq import get_logger
+
+logger = get_logger(__name__)
+timer = time.monotonic
+
+# Number of regex patterns whose matches are remembered
+PATTERN_CACHE_SIZE = 256
+
+
+@functools.lru_cache(maxsize=PATTERN_CACHE_SIZE)
+def compile_pattern(pattern):
+    return re.compile(pattern)
+
+
+def _trigrams(text):
+    return {text[i : i + 3] for i in range(len(text) - 2)}
+
+
+class MetricCatalog:
+    """All historic metrics and their metadata, kept in memory.
+
+    The catalog is loaded from the manager once and then refreshed in the background.
+    Lookups return None if the catalog cannot answer them, e.g. before it is loaded.
+    Callers should ask the manager instead in that case.
+    """
+
+    def __init__(self, client, refresh_interval=300):
+        self._client = client
+        self._refresh_interval = refresh_interval
+        self._task = None
+
+        self._metadata = None
+        # Sorted metric names for prefix searches
+        self._names = []
+        # Trigram -> indices into self._names for infix searches
+        self._trigrams = {}
+        # Pattern -> matching metric names
+        self._matches = OrderedDict()
+
+        self.last_refresh = None
+
+    @property
+    def loaded(self):
+        return self._metadata is not None
+
+    def __len__(self):
+        return len(self._names)
+
+    def start(self):
+        self._task = asyncio.ensure_future(self._refresh_periodically())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        with suppress(asyncio.CancelledError):
+            await self._task
+
+    async def _refresh_periodically(self):
+        while True:
+            try:
+                await self.refresh()
+            except Exception as e:
+                logger.error("failed to refresh metric catalog: {}", e)
+            await asyncio.sleep(self._refresh_interval)
+
+    async def refresh(self):
+        time_begin = timer()
+        # Bypass the cache of the client, we want the current list
+        metadata = await self._client.get_metrics(
+            metadata=True, historic=True, cache_read=False, cache_write=False
+        )
+        self.update(metadata)
+        self.last_refresh = time.time()
+        logger.info(
+            "metric catalog refreshed with {} metrics in {} s",
+            len(self._names),
+            timer() - time_begin,
+        )
+
+    def update(self, metadata):
+        names = sorted(metadata)
+        if names != self._names:
+            self._trigrams = self._build_trigram_index(names)
+            self._names = names
+            self._matches.clear()
+        self._metadata = metadata
+
+    @staticmethod
+    def _build_trigram_index(names):
+        index = defaultdict(list)
+        for position, name in enumerate(names):
+            for trigram in _trigrams(name):
+                index[trigram].append(position)
+        return {
+            trigram: np.array(positions, dtype=np.int32)
+            for trigram, positions in index.items()
+        }
+
+    def metadata(self, metric):
+        """Copy of the metadata of the metric, None if it is unknown"""
+        if not self.loaded:
+            return None
+        try:
+            return dict(self._metadata[metric])
+        except KeyError:
+            return None
+
+    def prefix(self, prefix, limit=None):
+        """Sorted metric names starting with prefix"""
+        if not self.loaded:
+            return None
+        result = []
+        for name in self._names[bisect.bisect_left(self._names, prefix) :]:
+            if not name.startswith(prefix) or len(result) == limit:
+                break
+            result.append(name)
+        return result
+
+    def infix(self, infix, limit=None):
+        """Sorted metric names containing infix"""
+        if not self.loaded:
+            return None
+        if len(infix) < 3:
+            candidates = self._names
+        else:
+            postings = sorted(
+                (
+                    self._trigrams.get(trigram, np.empty(0, dtype=np.int32))
+                    for trigram in _trigrams(infix)
+                ),
+                key=len,
+            )
+            positions = functools.reduce(
+                functools.partial(np.intersect1d, assume_unique=True), postings
+            )
+            candidates = [self._names[position] for position in positions.tolist()]
+        # The trigrams only narrow it down, they don't need to be consecutive
+        result = []
+        for name in candidates:
+            if len(result) == limit:
+                break
+            if infix in name:
+                result.append(name)
+        return result
+
+    def match(self, pattern, limit=None):
+        """Sorted metric names matching the regex pattern anywhere
+
+        Returns None if Python can't compile the pattern, the manager may still know it.
+        """
+        if not self.loaded:
+            return None
+        try:
+            result = self._matches[pattern]
+            self._matches.move_to_end(pattern)
+        except KeyError:
+            try:
+                search = compile_pattern(pattern).search
+            except re.error as e:
+                logger.debug("can't match metric pattern {}: {}", pattern, e)
+                return None
+            result = [name for name in self._names if search(name)]
+            self._matches[pattern] = result
+            if len(self._matches) > PATTERN_CACHE_SIZE:
+                self._matches.popitem(last=False)
+        return result[:limit]
+
+    def with_metadata(self, names):
+        return {name: self._metadata[name] for name in names}
@@ -1,10 +1,64 @@
+import asyncio
+import functools
 from typing import Optional, Sequence, Union
 
 from aiocache import SimpleMemoryCache, cached
-from metricq import HistoryClient
+from metricq import HistoryClient, get_logger
+from metricq.history_client import HistoryRequestType, HistoryResponse
+from metricq.types import Timedelta, Timestamp
+
+from .monitoring import current_endpoint, metrics
+from .request_context import (
+    RequestContext,
+    current_request,
+    current_target,
+    request_timeout,
+)
+from .scheduler import RequestScheduler
+
+logger = get_logger(__name__)
+
+
+class _InFlight:
+    """A history request shared by the callers waiting for it"""
+
+    def __init__(self, context: Optional[RequestContext]):
+        # The request runs on behalf of all of its callers, not just the first one
+        if context is None:
+            self.context = RequestContext(endpoint="", client=None)
+        else:
+            self.context = RequestContext(
+                context.endpoint, context.client, context.priority
+            )
+            self.context.deadline = context.deadline
+        self.future: Optional[asyncio.Future] = None
+        self.waiters = 0
+
+    def join(self, context: Optional[RequestContext]):
+        """Add a caller, the request takes as long as the latest deadline allows.
+
+        The most urgent priority only applies if the request doesn't already
+        wait for a slot of the scheduler.
+        """
+        self.waiters += 1
+        if context is None or context.deadline is None:
+            self.context.deadline = None
+        elif self.context.deadline is not None:
+            self.context.deadline = max(self.context.deadline, context.deadline)
+        if context is not None:
+            self.context.priority = min(self.context.priority, context.priority)
 
 
 class Client(HistoryClient):
+    def __init__(self, *args, scheduler: Optional[RequestScheduler] = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.scheduler = scheduler
+        # Identical history requests, which are currently in flight
+        self._history_requests = {}
+        self.history_requests = 0
+        self.coalesced_history_requests = 0
+        self.cancelled_history_requests = 0
+
     @cached(ttl=10 * 60, cache=SimpleMemoryCache, noself=True)
     async def get_metrics(
         self,
@@ -21,3 +75,116 @@ class Client(HistoryClient):
             timeout=timeout,
             **kwargs,
         )
+
+    async def history_data_request(
+        self,
+        metric: str,
+        start_time: Optional[Timestamp],
+        end_time: Optional[Timestamp],
+        interval_max: Optional[Timedelta],
+        request_type: HistoryRequestType = HistoryRequestType.AGGREGATE_TIMELINE,
+        timeout: float = 60,
+    ) -> HistoryResponse:
+        """Like :meth:`HistoryClient.history_data_request`, but identical requests
+        which are already in flight share a single request to the database.
+
+        Callers wait no longer than the deadline of their HTTP request.
+        The shared request runs until the latest deadline of its callers,
+        which also limits the timeout of the request to the database.
+        It is cancelled once all of its callers are gone,
+        e.g. because their clients disconnected or their deadlines expired.
+        """
+        key = (
+            metric,
+            start_time.posix_ns if start_time is not None else None,
+            end_time.posix_ns if end_time is not None else None,
+            interval_max.ns if interval_max is not None else None,
+            request_type,
+        )
+        self.history_requests += 1
+        wait_timeout = request_timeout(None)
+        if wait_timeout == 0:
+            raise asyncio.TimeoutError()
+        try:
+            in_flight = self._history_requests[key]
+            self.coalesced_history_requests += 1
+            logger.debug("coalescing history request for {}", metric)
+        except KeyError:
+            in_flight = self._history_requests[key] = _InFlight(current_request.get())
+            in_flight.future = asyncio.ensure_future(
+                self._shared_history_data_request(
+                    in_flight,
+                    metric,
+                    start_time,
+                    end_time,
+                    interval_max,
+                    request_type=request_type,
+                    timeout=timeout,
+                )
+            )
+            in_flight.future.add_done_callback(
+                functools.partial(self._history_request_done, key, in_flight)
+            )
+
+        in_flight.join(current_request.get())
+        try:
+            # A cancelled caller must not cancel the request for all the others
+            return await asyncio.wait_for(
+                asyncio.shield(in_flight.future), wait_timeout
+            )
+        finally:
+            in_flight.waiters -= 1
+            if in_flight.waiters == 0 and not in_flight.future.done():
+                logger.debug("cancelling history request for {}", metric)
+                self.cancelled_history_requests += 1
+                # Identical requests from now on must not join the cancelled one
+                del self._history_requests[key]
+                in_flight.future.cancel()
+
+    async def _shared_history_data_request(self, in_flight, *args, **kwargs):
+        # Not on behalf of the caller that happened to start the request
+        current_request.set(in_flight.context)
+        current_target.set(None)
+        return await self._scheduled_history_data_request(*args, **kwargs)
+
+    async def _scheduled_history_data_request(self, *args, **kwargs):
+        if self.scheduler is None:
+            return await self._timed_history_data_request(*args, **kwargs)
+        async with self.scheduler.slot():
+            return await self._timed_history_data_request(*args, **kwargs)
+
+    async def _timed_history_data_request(self, *args, timeout, **kwargs):
+        endpoint = current_endpoint()
+        # Waiting for a slot may have used up the time left for the request
+        timeout = request_timeout(timeout)
+        try:
+            if timeout == 0:
+                raise asyncio.TimeoutError()
+            with metrics.amqp_wait.labels(endpoint=endpoint).time():
+                response = await super().history_data_request(
+                    *args, timeout=timeout, **kwargs
+                )
+        except asyncio.TimeoutError:
+            metrics.timeouts.labels(endpoint=endpoint).inc()
+            raise
+        # The duration is -1 if the database didn't report it
+        if response.request_duration >= 0:
+            metrics.db_duration.labels(endpoint=endpoint).observe(
+                response.request_duration
+            )
+        return response
+
+    def _history_request_done(self, key, in_flight, request):
+        if self._history_requests.get(key) is in_flight:
+            del self._history_requests[key]
+        if not request.cancelled():
+            # Mark the exception as retrieved, even if every caller is gone
+            request.exception()
+
+    async def stop(self, exception: Optional[Exception] = None) -> None:
+        logger.info(
+            "coalesced {} of {} history requests",
+            self.coalesced_history_requests,
+            self.history_requests,
+        )
+        await super().stop(exception)
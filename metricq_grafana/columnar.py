@@ -0,0 +1,90 @@
+"""Binary columnar wire format for /timeline responses.
+
+Little-endian layout:
+
+* magic :code:`MQTL`, format version and header length as two uint32
+* the header, UTF-8 encoded JSON
+* the data section with the columns, each starting at a multiple of 8 bytes
+
+The header maps each metric to its result, like the JSON response, but instead
+of the list of entries, there is the number of entries ("length") and
+"columns", which maps the name of each column to its NumPy dtype and its byte
+offset. Offsets are relative to the data section, which starts at the first
+multiple of 8 bytes after the header.
+Aggregates have the columns of :class:`~.history_data.Aggregates`,
+raw values those of :class:`~.history_data.Values`. Timestamps are in ns.
+Due to the alignment, columns can be used directly as typed arrays.
+"""
+import json
+import struct
+
+import numpy as np
+from aiohttp import web
+
+from .monitoring import current_endpoint, metrics
+
+CONTENT_TYPE = "application/vnd.metricq.columnar"
+MAGIC = b"MQTL"
+FORMAT_VERSION = 1
+# magic, format version, header length
+_PREAMBLE = struct.Struct("<4sII")
+_ALIGNMENT = 8
+
+
+def _aligned(offset):
+    return -(-offset // _ALIGNMENT) * _ALIGNMENT
+
+
+def accepts_columnar(request: web.Request):
+    accept = request.headers.get("Accept", "")
+    return any(
+        media_range.split(";")[0].strip() == CONTENT_TYPE
+        for media_range in accept.split(",")
+    )
+
+
+def _little_endian(column: np.ndarray) -> np.ndarray:
+    return np.ascontiguousarray(column, dtype=column.dtype.newbyteorder("<"))
+
+
+def encode(results) -> bytes:
+    """Encode the results of a timeline request, metric -> result.
+
+    The entries of each result are columns, i.e. a NamedTuple of arrays.
+    """
+    header = {}
+    columns = []
+    for metric, result in results.items():
+        mode = result.get("mode")
+        entries = result.get(mode)
+        if entries is None:
+            header[metric] = result
+            continue
+        header[metric] = {key: value for key, value in result.items() if key != mode}
+        header[metric]["length"] = len(entries[0])
+        header[metric]["columns"] = {}
+        for name, column in zip(entries._fields, entries):
+            column = _little_endian(column)
+            header[metric]["columns"][name] = {"dtype": column.dtype.str}
+            columns.append((header[metric]["columns"][name], column))
+
+    offset = 0
+    for description, column in columns:
+        description["offset"] = offset
+        offset = _aligned(offset + column.nbytes)
+
+    encoded_header = json.dumps(header).encode()
+    data_begin = _aligned(_PREAMBLE.size + len(encoded_header))
+    body = bytearray(data_begin + offset)
+    _PREAMBLE.pack_into(body, 0, MAGIC, FORMAT_VERSION, len(encoded_header))
+    body[_PREAMBLE.size : _PREAMBLE.size + len(encoded_header)] = encoded_header
+    for description, column in columns:
+        begin = data_begin + description["offset"]
+        body[begin : begin + column.nbytes] = memoryview(column).cast("B")
+    return bytes(body)
+
+
+def columnar_response(request, results, headers=None) -> web.Response:
+    with metrics.serialization_duration.labels(endpoint=current_endpoint()).time():
+        body = encode(results)
+    return web.Response(body=body, content_type=CONTENT_TYPE, headers=headers)
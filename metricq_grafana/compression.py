@@ -0,0 +1,108 @@
+"""Module for compressing responses as negotiated via Accept-Encoding"""
+import asyncio
+import time
+import zlib
+
+from aiohttp import hdrs, web
+
+from .monitoring import metrics
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Bodies larger than this (in bytes) are compressed in the default executor
+OFFLOAD_SIZE = 1024 * 1024
+
+
+def _gzip(data: bytes) -> bytes:
+    # zlib.compress() only accepts wbits since Python 3.11
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    return compressor.compress(data) + compressor.flush()
+
+
+def _brotli(data: bytes) -> bytes:
+    return brotli.compress(data, quality=5)
+
+
+def _zstd(data: bytes) -> bytes:
+    # Compressors must not be shared between threads
+    return zstandard.ZstdCompressor(level=3).compress(data)
+
+
+# Available encodings, preferred first
+ENCODERS = {}
+if zstandard is not None:
+    ENCODERS["zstd"] = _zstd
+if brotli is not None:
+    ENCODERS["br"] = _brotli
+ENCODERS["gzip"] = _gzip
+
+
+def negotiate(accept_encoding: str):
+    """The best available encoding the client accepts, if any"""
+    accepted = {}
+    for coding in accept_encoding.split(","):
+        name, *parameters = (part.strip() for part in coding.split(";"))
+        quality = 1.0
+        for parameter in parameters:
+            key, _, value = parameter.partition("=")
+            if key.strip() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        accepted[name.lower()] = quality
+
+    candidates = [
+        (accepted.get(name, accepted.get("*", 0.0)), -preference, name)
+        for preference, name in enumerate(ENCODERS)
+    ]
+    quality, _, name = max(candidates)
+    return name if quality > 0 else None
+
+
+def _compress(encoding, body):
+    begin = time.thread_time_ns()
+    compressed = ENCODERS[encoding](body)
+    return compressed, (time.thread_time_ns() - begin) / 1e9
+
+
+@web.middleware
+async def compression_middleware(request, handler):
+    """Compress response bodies of at least app["compression_min_size"] bytes"""
+    response = await handler(request)
+    # Streamed responses such as WebSockets are left alone
+    if type(response) is not web.Response or hdrs.CONTENT_ENCODING in response.headers:
+        return response
+    body = response.body
+    if (
+        not isinstance(body, (bytes, bytearray))
+        or len(body) < request.app["compression_min_size"]
+    ):
+        return response
+
+    response.headers.add(hdrs.VARY, hdrs.ACCEPT_ENCODING)
+    encoding = negotiate(request.headers.get(hdrs.ACCEPT_ENCODING, ""))
+    if encoding is None:
+        return response
+
+    if len(body) > OFFLOAD_SIZE:
+        compressed, duration = await asyncio.get_running_loop().run_in_executor(
+            None, _compress, encoding, body
+        )
+    else:
+        compressed, duration = _compress(encoding, body)
+    metrics.compression_duration.labels(encoding=encoding).observe(duration)
+
+    response.body = compressed
+    response.headers[hdrs.CONTENT_ENCODING] = encoding
+    response.headers["x-compression-ratio"] = str(len(body) / len(compressed))
+    response.headers["x-compression-duration-cpu"] = str(duration)
+    return response
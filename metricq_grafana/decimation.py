@@ -0,0 +1,117 @@
+"""Downsampling of raw values to a number of points that can actually be displayed.
+
+All decimators take the columns of a series and return the sorted indices of
+the points to keep, at most max_points of them.
+"""
+import numpy as np
+
+
+def _segment_argmax(scores, starts, segment_ids):
+    """Index of the first maximum of scores within each segment"""
+    maxima = np.maximum.reduceat(scores, starts)
+    candidates = np.flatnonzero(scores == maxima[segment_ids])
+    _, first = np.unique(segment_ids[candidates], return_index=True)
+    return candidates[first]
+
+
+def _ends(count, max_points) -> np.ndarray:
+    """The first and last point, as many of them as max_points allows"""
+    return np.array([0, count - 1][: max(max_points, 0)], dtype=np.int64)
+
+
+def lttb(timestamps: np.ndarray, values: np.ndarray, max_points) -> np.ndarray:
+    """Largest-Triangle-Three-Buckets, keeps the visually most significant points.
+
+    The first and last point are always kept, the others are split into
+    max_points - 2 buckets, of which the point forming the largest triangle with
+    its neighboring buckets is kept.
+    As opposed to the original algorithm, the triangle is anchored at the average
+    of the previous bucket instead of the point selected there, so that all
+    buckets can be evaluated at once.
+    With max_points below 3, only the first and/or last point are kept.
+    """
+    count = len(timestamps)
+    max_points = int(max_points)
+    if count <= max_points:
+        return np.arange(count)
+    if max_points < 3:
+        return _ends(count, max_points)
+
+    x = (timestamps - timestamps[0]).astype(np.float64)
+    y = values.astype(np.float64, copy=False)
+    buckets = max_points - 2
+    # Buckets of the points between first and last
+    starts = 1 + (np.arange(buckets) * (count - 2)) // buckets
+    sizes = np.diff(np.append(starts, count - 1))
+    bucket_ids = np.repeat(np.arange(buckets), sizes)
+
+    finite_y = np.where(np.isfinite(y), y, 0.0)
+    average_x = np.add.reduceat(x[1:-1], starts - 1) / sizes
+    average_y = np.add.reduceat(finite_y[1:-1], starts - 1) / sizes
+
+    # For each bucket, the anchors are the averages of the neighboring buckets,
+    # or the first and last point at the edges
+    previous_x = np.concatenate(([x[0]], average_x[:-1]))[bucket_ids]
+    previous_y = np.concatenate(([finite_y[0]], average_y[:-1]))[bucket_ids]
+    next_x = np.concatenate((average_x[1:], [x[-1]]))[bucket_ids]
+    next_y = np.concatenate((average_y[1:], [finite_y[-1]]))[bucket_ids]
+
+    area = np.abs(
+        (previous_x - next_x) * (y[1:-1] - previous_y)
+        - (previous_x - x[1:-1]) * (next_y - previous_y)
+    )
+    # Points without a value are only chosen if there is nothing else
+    area[~np.isfinite(area)] = -1.0
+
+    selected = 1 + _segment_argmax(area, starts - 1, bucket_ids)
+    return np.concatenate(([0], selected, [count - 1]))
+
+
+def minmax(timestamps: np.ndarray, values: np.ndarray, max_points) -> np.ndarray:
+    """Keep the minimum and maximum within each of max_points / 2 equal time buckets.
+
+    This preserves every peak, as drawn by a line with one bucket per pixel.
+    """
+    count = len(timestamps)
+    max_points = int(max_points)
+    if count <= max_points:
+        return np.arange(count)
+    if max_points < 2:
+        return _ends(count, max_points)
+
+    buckets = max_points // 2
+    offsets = (timestamps - timestamps[0]).astype(np.float64)
+    # The timestamps are sorted, so are the bucket ids
+    bucket_of_point = np.minimum(
+        (offsets * (buckets / (offsets[-1] + 1))).astype(np.int64), buckets - 1
+    )
+    starts = np.flatnonzero(np.diff(bucket_of_point, prepend=-1))
+    segment_ids = np.repeat(np.arange(len(starts)), np.diff(np.append(starts, count)))
+
+    y = values.astype(np.float64, copy=False)
+    # Points without a value are only chosen if there is nothing else
+    high = np.where(np.isnan(y), -np.inf, y)
+    low = np.where(np.isnan(y), -np.inf, -y)
+    selected = np.concatenate(
+        (
+            _segment_argmax(high, starts, segment_ids),
+            _segment_argmax(low, starts, segment_ids),
+        )
+    )
+    return np.unique(selected)
+
+
+DECIMATORS = {
+    "lttb": lttb,
+    "minmax": minmax,
+}
+
+
+def get_decimator(name="lttb"):
+    """Return the decimator with the given name, None for "none" """
+    if name == "none":
+        return None
+    try:
+        return DECIMATORS[name]
+    except KeyError:
+        raise ValueError(f"Unknown decimation '{name}'")
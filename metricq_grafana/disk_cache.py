@@ -0,0 +1,226 @@
+"""On-disk tier of the history cache for tiles which won't change anymore.
+
+Each tile is a segment file with a JSON header followed by its columns,
+which are read through mmap.
+The header contains the full key of the tile, so that a file is only ever used
+for exactly the tile it was written for.
+"""
+import asyncio
+import hashlib
+import json
+import mmap
+import os
+import struct
+import tempfile
+import time
+from collections import OrderedDict
+from contextlib import suppress
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+from metricq import get_logger
+from metricq.history_client import HistoryResponseType
+
+from .history_data import Aggregates, HistoryData, Values
+
+logger = get_logger(__name__)
+
+MAGIC = b"MQGT"
+FORMAT_VERSION = 1
+SUFFIX = ".tile"
+# magic, format version, header length
+_PREAMBLE = struct.Struct("<4sII")
+_ALIGNMENT = 8
+# Temporary files older than this (in s) are not being written anymore
+STALE_WRITE_AGE = 3600
+
+
+def _aligned(offset):
+    return -(-offset // _ALIGNMENT) * _ALIGNMENT
+
+
+def _encode_key(key):
+    metric, interval_ns, request_type, index = key
+    return [metric, interval_ns, request_type.value, index]
+
+
+def _columns(data: HistoryData):
+    if data.mode is HistoryResponseType.AGGREGATES:
+        return data.aggregates()
+    if data.mode is HistoryResponseType.VALUES:
+        return data.values()
+    return ()
+
+
+def _write_segment(path: Path, key, data: HistoryData):
+    columns = _columns(data)
+    header = json.dumps(
+        {
+            "key": key,
+            "mode": data.mode.value,
+            "request_duration": data.request_duration,
+            "length": len(data),
+            "columns": [column.dtype.str for column in columns],
+        }
+    ).encode()
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    descriptor, temporary = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+    with open(descriptor, "wb") as file:
+        file.write(_PREAMBLE.pack(MAGIC, FORMAT_VERSION, len(header)))
+        file.write(header)
+        for column in columns:
+            file.write(b"\0" * (_aligned(file.tell()) - file.tell()))
+            file.write(np.ascontiguousarray(column).tobytes())
+        size = file.tell()
+    # Readers never see a partially written segment
+    os.replace(temporary, path)
+    return size
+
+
+def _read_segment(path: Path, key) -> HistoryData:
+    with open(path, "rb") as file, mmap.mmap(
+        file.fileno(), 0, access=mmap.ACCESS_READ
+    ) as buffer:
+        magic, version, header_length = _PREAMBLE.unpack_from(buffer)
+        if magic != MAGIC or version != FORMAT_VERSION:
+            raise ValueError("unknown segment format")
+        offset = _PREAMBLE.size
+        header = json.loads(bytes(buffer[offset : offset + header_length]))
+        if header["key"] != key:
+            raise ValueError(f"segment belongs to {header['key']}")
+        offset += header_length
+
+        length = header["length"]
+        columns = []
+        for dtype in map(np.dtype, header["columns"]):
+            if length == 0:
+                columns.append(np.empty(0, dtype=dtype))
+                continue
+            offset = _aligned(offset)
+            if offset + length * dtype.itemsize > len(buffer):
+                raise ValueError("segment is truncated")
+            # Copy, so that the mapping (and its file descriptor) can be closed
+            columns.append(
+                np.frombuffer(buffer, dtype=dtype, count=length, offset=offset).copy()
+            )
+            offset += length * dtype.itemsize
+
+    mode = HistoryResponseType(header["mode"])
+    request_duration = header["request_duration"]
+    if mode is HistoryResponseType.AGGREGATES:
+        return HistoryData(mode, request_duration, aggregates=Aggregates(*columns))
+    if mode is HistoryResponseType.VALUES:
+        return HistoryData(mode, request_duration, values=Values(*columns))
+    return HistoryData(mode, request_duration)
+
+
+class DiskTileStore:
+    """Size-bounded directory of tile segments, least recently used are removed first.
+
+    Files are read and written in the default executor, so that the event loop
+    doesn't wait for the disk.
+    """
+
+    def __init__(self, path, max_bytes):
+        self._path = Path(path)
+        self._max_bytes = max_bytes
+        # segment path -> size, least recently used first
+        self._segments = OrderedDict()
+        self._bytes = 0
+        self._writes = set()
+
+        self.hits = 0
+        self.misses = 0
+
+    def open(self):
+        """Index the segments of a previous run"""
+        self._path.mkdir(parents=True, exist_ok=True)
+        found = []
+        for directory in self._path.iterdir():
+            if not directory.is_dir():
+                continue
+            for entry in os.scandir(directory):
+                stat = entry.stat()
+                if entry.name.endswith(SUFFIX):
+                    found.append((stat.st_mtime, Path(entry.path), stat.st_size))
+                elif stat.st_mtime < time.time() - STALE_WRITE_AGE:
+                    # Left over from an interrupted write
+                    with suppress(OSError):
+                        os.unlink(entry.path)
+        for _, path, size in sorted(found):
+            self._segments[path] = size
+            self._bytes += size
+        self._evict()
+        logger.info(
+            "disk cache at {} contains {} tiles with {} bytes",
+            self._path,
+            len(self._segments),
+            self._bytes,
+        )
+
+    async def close(self):
+        await asyncio.gather(*self._writes)
+
+    def __len__(self):
+        return len(self._segments)
+
+    @property
+    def bytes(self):
+        return self._bytes
+
+    def _segment_path(self, key):
+        digest = hashlib.sha256(json.dumps(key).encode()).hexdigest()
+        return self._path / digest[:2] / (digest + SUFFIX)
+
+    async def load(self, key) -> Optional[HistoryData]:
+        key = _encode_key(key)
+        path = self._segment_path(key)
+        if path not in self._segments:
+            self.misses += 1
+            return None
+
+        try:
+            data = await asyncio.get_running_loop().run_in_executor(
+                None, _read_segment, path, key
+            )
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning("dropping invalid disk cache segment {}: {}", path, e)
+            self._remove(path)
+            self.misses += 1
+            return None
+
+        if path in self._segments:
+            self._segments.move_to_end(path)
+        self.hits += 1
+        return data
+
+    def save(self, key, data: HistoryData):
+        """Write the tile in the background"""
+        task = asyncio.ensure_future(self._save(_encode_key(key), data))
+        self._writes.add(task)
+        task.add_done_callback(self._writes.discard)
+
+    async def _save(self, key, data):
+        path = self._segment_path(key)
+        try:
+            size = await asyncio.get_running_loop().run_in_executor(
+                None, _write_segment, path, key, data
+            )
+        except OSError as e:
+            logger.warning("failed to write disk cache segment {}: {}", path, e)
+            return
+
+        self._bytes += size - self._segments.pop(path, 0)
+        self._segments[path] = size
+        self._evict()
+
+    def _remove(self, path):
+        self._bytes -= self._segments.pop(path, 0)
+        with suppress(OSError):
+            path.unlink()
+
+    def _evict(self):
+        while self._bytes > self._max_bytes and self._segments:
+            self._remove(next(iter(self._segments)))
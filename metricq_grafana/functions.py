@@ -1,8 +1,10 @@
 from abc import ABC, abstractmethod
 
-from metricq.history_client import HistoryResponse, HistoryResponseType
+import numpy as np
 from metricq.types import Timedelta
 
+from .history_data import HistoryData
+
 
 def parse_functions(target_dict):
     for function in target_dict.get("functions", ["avg"]):
@@ -41,12 +43,20 @@ class Function(ABC):
         pass
 
     @abstractmethod
-    def transform_data(self, response):
+    def transform_data(self, data: HistoryData):
+        """Return arrays of timestamps (ns) and values, NaN for missing values"""
         pass
 
 
 class AggregateFunction(Function, ABC):
-    pass
+    def transform_data(self, data: HistoryData):
+        aggregates = data.aggregates()
+        values = self._aggregate_values(aggregates)
+        return aggregates.timestamp, np.where(aggregates.count != 0, values, np.nan)
+
+    @abstractmethod
+    def _aggregate_values(self, aggregates):
+        pass
 
 
 class AvgFunction(AggregateFunction):
@@ -57,12 +67,8 @@ class AvgFunction(AggregateFunction):
     def _order(self):
         return 2
 
-    def transform_data(self, response):
-        for timeaggregate in response.aggregates():
-            if timeaggregate.count != 0:
-                yield timeaggregate.timestamp, timeaggregate.mean
-            else:
-                yield timeaggregate.timestamp, None
+    def _aggregate_values(self, aggregates):
+        return aggregates.mean()
 
 
 class MinFunction(AggregateFunction):
@@ -73,12 +79,8 @@ class MinFunction(AggregateFunction):
     def _order(self):
         return 3
 
-    def transform_data(self, response):
-        for timeaggregate in response.aggregates():
-            if timeaggregate.count != 0:
-                yield timeaggregate.timestamp, timeaggregate.minimum
-            else:
-                yield timeaggregate.timestamp, None
+    def _aggregate_values(self, aggregates):
+        return aggregates.minimum
 
 
 class MaxFunction(AggregateFunction):
@@ -89,12 +91,8 @@ class MaxFunction(AggregateFunction):
     def _order(self):
         return 1
 
-    def transform_data(self, response):
-        for timeaggregate in response.aggregates():
-            if timeaggregate.count != 0:
-                yield timeaggregate.timestamp, timeaggregate.maximum
-            else:
-                yield timeaggregate.timestamp, None
+    def _aggregate_values(self, aggregates):
+        return aggregates.maximum
 
 
 class CountFunction(AggregateFunction):
@@ -105,12 +103,8 @@ class CountFunction(AggregateFunction):
     def _order(self):
         return 0
 
-    def transform_data(self, response):
-        for timeaggregate in response.aggregates():
-            if timeaggregate.count != 0:
-                yield timeaggregate.timestamp, timeaggregate.count
-            else:
-                yield timeaggregate.timestamp, None
+    def _aggregate_values(self, aggregates):
+        return aggregates.count
 
 
 class RawFunction(Function):
@@ -121,9 +115,8 @@ class RawFunction(Function):
     def _order(self):
         return 2
 
-    def transform_data(self, response: HistoryResponse):
-        for tv in response.values(convert=False):
-            yield tv.timestamp, tv.value
+    def transform_data(self, data: HistoryData):
+        return data.values()
 
 
 class MovingAverageFunction(Function):
@@ -137,99 +130,73 @@ class MovingAverageFunction(Function):
     def _order(self):
         return 4
 
-    def _calculate_interval_durations(self, response_aggregates):
+    def transform_data(self, data: HistoryData):
+        aggregates = data.aggregates(convert=True)
+        timestamps = aggregates.timestamp
+
+        if len(timestamps) < 2:
+            return timestamps[:0], np.empty(0)
+
         # we assume LAST semantic, but this should not matter for equidistant intervals
-        yield Timedelta(0)
-
-        for previous_ta, current_ta in zip(
-            response_aggregates, response_aggregates[1:]
-        ):
-            duration = current_ta.timestamp - previous_ta.timestamp
-            # We need strong monotony. DB-HTA guarantees it currently
-            assert duration > Timedelta(0)
-            yield duration
-
-    def transform_data(self, response):
-        response_aggregates = list(response.aggregates(convert=True))
-
-        if len(response_aggregates) == 0:
-            return []
-
-        ma_integral_ns = 0
-        ma_active_time = Timedelta(0)
-        ma_begin_index = 1
-        ma_begin_time = response_aggregates[0].timestamp
-        ma_end_index = 1
-        ma_end_time = response_aggregates[0].timestamp
-
-        interval_durations = list(
-            self._calculate_interval_durations(response_aggregates)
+        # interval i spans (timestamps[i - 1], timestamps[i]], the first one is empty
+        interval_durations = np.diff(timestamps, prepend=timestamps[0])
+        # We need strong monotony. DB-HTA guarantees it currently
+        assert np.all(interval_durations[1:] > 0)
+
+        # The moving average window is symmetric around the current *interval* - not the current point
+
+        # How much time is covered by the current interval width and how much is on both sides "outside"
+        # If the current interval is wider than the target moving average window, just use the current one
+        outside_duration = np.maximum(self.interval.ns - interval_durations, 0)
+        seek_begin_time = timestamps - interval_durations - outside_duration // 2
+        seek_end_time = timestamps + outside_duration // 2
+
+        # The window only ever moves forward and must be completely within the data
+        complete = (
+            (seek_begin_time >= timestamps[0])
+            & (seek_begin_time == np.maximum.accumulate(seek_begin_time))
+            & (seek_end_time <= timestamps[-1])
+            & (seek_end_time == np.maximum.accumulate(seek_end_time))
+        )
+        seek_begin_time = seek_begin_time[complete]
+        seek_end_time = seek_end_time[complete]
+
+        ma_integral_ns = self._window_sum(
+            timestamps,
+            interval_durations,
+            aggregates.integral_ns,
+            seek_begin_time,
+            seek_end_time,
+        )
+        ma_active_time = self._window_sum(
+            timestamps,
+            interval_durations,
+            aggregates.active_time,
+            seek_begin_time,
+            seek_end_time,
         )
 
-        for timeaggregate, current_interval_duration in zip(
-            response_aggregates, interval_durations
-        ):
-            # The moving average window is symmetric around the current *interval* - not the current point
-
-            # How much time is covered by the current interval width and how much is on both sides "outside"
-            assert current_interval_duration >= Timedelta(0)
-            outside_duration = self.interval - current_interval_duration
-            # If the current interval is wider than the target moving average window, just use the current one
-            outside_duration = max(Timedelta(0), outside_duration)
-            seek_begin_time = (
-                timeaggregate.timestamp
-                - current_interval_duration
-                - outside_duration / 2
-            )
-            seek_end_time = timeaggregate.timestamp + outside_duration / 2
-
-            # TODO unify these two loops
-            # Move left part of the window
-            while ma_begin_time < seek_begin_time:
-                next_step_time = min(
-                    response_aggregates[ma_begin_index].timestamp, seek_begin_time
-                )
-                step_duration = next_step_time - ma_begin_time
-                # scale can be 0 (everything is nop),
-                # 1 (full interval needs to be removed), or something in between
-                scale = step_duration.ns / interval_durations[ma_begin_index].ns
-                ma_active_time -= (
-                    response_aggregates[ma_begin_index].active_time * scale
-                )
-                ma_integral_ns -= (
-                    response_aggregates[ma_begin_index].integral_ns * scale
-                )
+        has_active_time = ma_active_time > 0
+        return (
+            timestamps[complete][has_active_time],
+            ma_integral_ns[has_active_time] / ma_active_time[has_active_time],
+        )
 
-                ma_begin_time = next_step_time
-                assert ma_begin_time <= response_aggregates[ma_begin_index].timestamp
-                if ma_begin_time == response_aggregates[ma_begin_index].timestamp:
-                    # Need to move to the next interval
-                    ma_begin_index += 1
-
-            # Move right part of the window
-            while ma_end_time < seek_end_time and ma_end_index < len(
-                response_aggregates
-            ):
-                next_step_time = min(
-                    response_aggregates[ma_end_index].timestamp, seek_end_time
-                )
-                step_duration = next_step_time - ma_end_time
-                # scale can be 0 (everything is nop),
-                # 1 (full interval needs to be removed), or something in between
-                scale = step_duration.ns / interval_durations[ma_end_index].ns
-                ma_active_time += response_aggregates[ma_end_index].active_time * scale
-                ma_integral_ns += response_aggregates[ma_end_index].integral_ns * scale
-
-                ma_end_time = next_step_time
-                assert ma_end_time <= response_aggregates[ma_end_index].timestamp
-                if ma_end_time == response_aggregates[ma_end_index].timestamp:
-                    # Need to move to the next interval
-                    ma_end_index += 1
-
-            if seek_begin_time != ma_begin_time or seek_end_time != ma_end_time:
-                # Interval window not complete
-                continue
-            if ma_active_time == 0:
-                continue
-
-            yield timeaggregate.timestamp, ma_integral_ns / ma_active_time.ns
+    @staticmethod
+    def _window_sum(timestamps, interval_durations, column, begin_time, end_time):
+        """Sum of column within [begin_time, end_time] for each window.
+
+        Each interval contributes proportionally to its overlap with the window.
+        """
+        # prefix[i] is the sum of the first i intervals (the first one is empty)
+        prefix = np.concatenate(([0.0], np.cumsum(column[1:], dtype=np.float64)))
+
+        def cumulative(time):
+            # index of the interval containing time, a time at the very beginning
+            # is treated as the beginning of the first non-empty interval
+            index = np.maximum(np.searchsorted(timestamps, time, side="left"), 1)
+            # scale can be 0 (nothing of the interval), 1 (full interval) or something in between
+            scale = (time - timestamps[index - 1]) / interval_durations[index]
+            return prefix[index - 1] + column[index] * scale
+
+        return cumulative(end_time) - cumulative(begin_time)
@@ -0,0 +1,315 @@
+"""Columnar view of history responses based on NumPy arrays"""
+from typing import NamedTuple, Optional
+
+import numpy as np
+from metricq import history_pb2
+from metricq.history_client import HistoryResponse, HistoryResponseType
+from metricq.types import TimeAggregate, Timedelta, Timestamp
+
+
+class Aggregates(NamedTuple):
+    """Columns of a list of TimeAggregates, timestamps and durations in ns"""
+
+    timestamp: np.ndarray
+    minimum: np.ndarray
+    maximum: np.ndarray
+    sum: np.ndarray
+    count: np.ndarray
+    integral_ns: np.ndarray
+    active_time: np.ndarray
+
+    def mean(self):
+        """Vectorized TimeAggregate.mean, NaN where count is 0"""
+        with np.errstate(divide="ignore", invalid="ignore"):
+            mean = np.where(
+                self.active_time > 0,
+                self.integral_ns / self.active_time,
+                self.sum / self.count,
+            )
+        return np.where(self.count != 0, mean, np.nan)
+
+
+class Values(NamedTuple):
+    """Columns of a list of TimeValues, timestamps in ns"""
+
+    timestamp: np.ndarray
+    value: np.ndarray
+
+
+class HistoryData:
+    """Columnar history data, e.g. from a HistoryResponse.
+
+    Responses are decoded lazily and only once into NumPy arrays, so they can be
+    shared by all functions of a target.
+    The methods :meth:`aggregates` and :meth:`values` follow the semantics
+    of the respective methods of :class:`HistoryResponse`, but return columns.
+    """
+
+    def __init__(
+        self,
+        mode: HistoryResponseType,
+        request_duration=None,
+        aggregates: Optional[Aggregates] = None,
+        values: Optional[Values] = None,
+    ):
+        self.mode = mode
+        self.request_duration = request_duration
+        self._response = None
+        self._aggregates = aggregates
+        self._values = values
+
+    @classmethod
+    def from_response(cls, response: HistoryResponse) -> "HistoryData":
+        data = cls(response.mode, response.request_duration)
+        data._response = response
+        return data
+
+    @classmethod
+    def _from_protobuf(cls, message: bytes, request_duration) -> "HistoryData":
+        proto = history_pb2.HistoryResponse.FromString(message)
+        return cls.from_response(HistoryResponse(proto, request_duration))
+
+    def __reduce__(self):
+        # Pickled e.g. for worker processes: as the compact protobuf message
+        # while not decoded yet, afterwards as columns
+        if (
+            self._response is not None
+            and self._aggregates is None
+            and self._values is None
+        ):
+            return (
+                HistoryData._from_protobuf,
+                (self._response._proto.SerializeToString(), self.request_duration),
+            )
+        return (
+            HistoryData,
+            (self.mode, self.request_duration, self._aggregates, self._values),
+        )
+
+    @classmethod
+    def concatenate(cls, parts, request_duration=None) -> Optional["HistoryData"]:
+        """Concatenate consecutive parts, entries at overlapping boundaries are dropped.
+
+        Returns None if the parts contain different types of data.
+        """
+        modes = {part.mode for part in parts} - {HistoryResponseType.EMPTY}
+        if not modes:
+            return cls(HistoryResponseType.EMPTY, request_duration)
+        if len(modes) > 1 or not modes <= {
+            HistoryResponseType.AGGREGATES,
+            HistoryResponseType.VALUES,
+        }:
+            return None
+
+        mode = modes.pop()
+        columns = [part._columns() for part in parts if part.mode is mode]
+        columns = type(columns[0])(*map(np.concatenate, zip(*columns)))
+        timestamps = columns.timestamp
+        keep = np.ones(len(timestamps), dtype=bool)
+        keep[1:] = timestamps[1:] > np.maximum.accumulate(timestamps)[:-1]
+        return cls._from_columns(mode, request_duration, columns, keep)
+
+    def __len__(self):
+        if self._response is not None:
+            return len(self._response)
+        return len(self.timestamps)
+
+    @property
+    def timestamps(self) -> np.ndarray:
+        return self._columns().timestamp
+
+    def trim(self, start_ns, end_ns) -> "HistoryData":
+        """Restrict to the given range, but keep one entry on each side,
+        just like the database does.
+        """
+        timestamps = self.timestamps
+        begin = max(np.searchsorted(timestamps, start_ns, side="right") - 1, 0)
+        end = min(np.searchsorted(timestamps, end_ns, side="left") + 1, len(timestamps))
+        if begin == 0 and end == len(timestamps):
+            return self
+        return self._from_columns(
+            self.mode, self.request_duration, self._columns(), slice(begin, end)
+        )
+
+    def head(self, end_ns) -> "HistoryData":
+        """Only the entries before end_ns"""
+        end = np.searchsorted(self.timestamps, end_ns, side="left")
+        return self._from_columns(
+            self.mode, self.request_duration, self._columns(), slice(0, end)
+        )
+
+    def aggregate(self, start_ns, end_ns) -> Optional[TimeAggregate]:
+        """A single aggregate over the range, like from a history_aggregate request.
+
+        Aggregates are merged if their timestamp is within the range.
+        At the edges of the range, this is only approximate: an interval that
+        only partially overlaps the range counts as a whole or not at all,
+        depending on its timestamp. The error is at most one interval at each
+        edge, which is small for the intervals of a timeline.
+        Raw values are weighted by the time they were current (LAST semantics)
+        within the range.
+        Returns None if the range contains no values or, for raw values,
+        is not covered by them.
+        """
+        if self.mode is HistoryResponseType.AGGREGATES:
+            aggregates = self.aggregates()
+            timestamps = aggregates.timestamp
+            inside = (start_ns <= timestamps) & (timestamps < end_ns)
+            has_values = inside & (aggregates.count > 0)
+            if not np.any(has_values):
+                return None
+            return TimeAggregate(
+                timestamp=Timestamp(start_ns),
+                minimum=float(aggregates.minimum[has_values].min()),
+                maximum=float(aggregates.maximum[has_values].max()),
+                sum=float(aggregates.sum[inside].sum()),
+                count=int(aggregates.count[inside].sum()),
+                integral_ns=float(aggregates.integral_ns[inside].sum()),
+                active_time=Timedelta(int(aggregates.active_time[inside].sum())),
+            )
+        if self.mode is not HistoryResponseType.VALUES:
+            return None
+
+        values = self.values()
+        timestamps = values.timestamp
+        inside = (start_ns <= timestamps) & (timestamps <= end_ns)
+        if (
+            len(timestamps) == 0
+            or timestamps[0] > start_ns
+            or timestamps[-1] < end_ns
+            or not np.any(inside)
+        ):
+            return None
+        # Each value is current from the previous timestamp until its own
+        active_time = np.maximum(
+            np.minimum(timestamps[1:], end_ns) - np.maximum(timestamps[:-1], start_ns),
+            0,
+        )
+        return TimeAggregate(
+            timestamp=Timestamp(start_ns),
+            minimum=float(values.value[inside].min()),
+            maximum=float(values.value[inside].max()),
+            sum=float(values.value[inside].sum()),
+            count=int(np.count_nonzero(inside)),
+            integral_ns=float((active_time * values.value[1:]).sum()),
+            active_time=Timedelta(int(active_time.sum())),
+        )
+
+    def aggregates(self, convert=False) -> Aggregates:
+        if self.mode is HistoryResponseType.AGGREGATES:
+            if self._aggregates is None:
+                self._aggregates = self._decode_aggregates()
+            return self._aggregates
+        elif self.mode is HistoryResponseType.EMPTY:
+            return _empty_aggregates()
+
+        if not convert:
+            raise ValueError(
+                f"Attempting to access aggregates of HistoryData in mode {self.mode}"
+            )
+
+        if self.mode is HistoryResponseType.VALUES:
+            return self._values_to_aggregates(self.values())
+
+        raise ValueError("Invalid HistoryResponse mode")
+
+    def values(self, convert=False) -> Values:
+        if self.mode is HistoryResponseType.VALUES:
+            if self._values is None:
+                self._values = self._decode_values()
+            return self._values
+        elif self.mode is HistoryResponseType.EMPTY:
+            return _empty_values()
+
+        if not convert:
+            raise ValueError(
+                f"Attempting to access values of HistoryData in mode {self.mode}"
+            )
+
+        if self.mode is HistoryResponseType.AGGREGATES:
+            aggregates = self.aggregates()
+            return Values(aggregates.timestamp, aggregates.mean())
+
+        raise ValueError("Invalid HistoryResponse mode")
+
+    def _columns(self):
+        if self.mode is HistoryResponseType.AGGREGATES:
+            return self.aggregates()
+        elif self.mode is HistoryResponseType.VALUES:
+            return self.values()
+        elif self.mode is HistoryResponseType.EMPTY:
+            return _empty_values()
+        raise ValueError("Invalid HistoryResponse mode")
+
+    @classmethod
+    def _from_columns(cls, mode, request_duration, columns, index):
+        columns = type(columns)(*(column[index] for column in columns))
+        if mode is HistoryResponseType.AGGREGATES:
+            return cls(mode, request_duration, aggregates=columns)
+        return cls(mode, request_duration, values=columns)
+
+    def _decode_timestamps(self):
+        # There is no public API to get the protobuf message
+        time_delta = self._response._proto.time_delta
+        return np.cumsum(np.fromiter(time_delta, dtype=np.int64, count=len(time_delta)))
+
+    def _decode_values(self):
+        value = self._response._proto.value
+        return Values(
+            self._decode_timestamps(),
+            np.fromiter(value, dtype=np.float64, count=len(value)),
+        )
+
+    def _decode_aggregates(self):
+        proto_aggregates = self._response._proto.aggregate
+        count = len(proto_aggregates)
+
+        def column(field, dtype):
+            return np.fromiter(
+                (getattr(aggregate, field) for aggregate in proto_aggregates),
+                dtype=dtype,
+                count=count,
+            )
+
+        return Aggregates(
+            timestamp=self._decode_timestamps(),
+            minimum=column("minimum", np.float64),
+            maximum=column("maximum", np.float64),
+            sum=column("sum", np.float64),
+            count=column("count", np.int64),
+            integral_ns=column("integral", np.float64),
+            active_time=column("active_time", np.int64),
+        )
+
+    @staticmethod
+    def _values_to_aggregates(values: Values):
+        """Same as TimeAggregate.from_value_pair for each pair of values"""
+        if len(values.timestamp) == 0:
+            return _empty_aggregates()
+        value = values.value[1:]
+        active_time = np.diff(values.timestamp)
+        return Aggregates(
+            timestamp=values.timestamp[:-1],
+            minimum=value,
+            maximum=value,
+            sum=value,
+            count=np.ones(len(value), dtype=np.int64),
+            integral_ns=active_time * value,
+            active_time=active_time,
+        )
+
+
+def _empty_values():
+    return Values(np.empty(0, dtype=np.int64), np.empty(0))
+
+
+def _empty_aggregates():
+    return Aggregates(
+        timestamp=np.empty(0, dtype=np.int64),
+        minimum=np.empty(0),
+        maximum=np.empty(0),
+        sum=np.empty(0),
+        count=np.empty(0, dtype=np.int64),
+        integral_ns=np.empty(0),
+        active_time=np.empty(0, dtype=np.int64),
+    )
@@ -0,0 +1,227 @@
+"""Module for pushing live data from MetricQ to connected clients"""
+import asyncio
+from collections import defaultdict
+
+import numpy as np
+from metricq import Sink, get_logger
+from metricq.types import Timedelta, Timestamp
+
+logger = get_logger(__name__)
+
+# Intervals are completed this long after their end, unless newer values complete
+# them earlier, because values arrive in chunks
+COMPLETION_DELAY = Timedelta.from_s(2)
+
+
+class _Bucket:
+    """Aggregate of the live values of one metric within one interval"""
+
+    __slots__ = ("timestamp", "minimum", "maximum", "sum", "count")
+
+    def __init__(self, timestamp):
+        self.timestamp = timestamp
+        self.minimum = float("inf")
+        self.maximum = float("-inf")
+        self.sum = 0.0
+        self.count = 0
+
+    def add(self, minimum, maximum, total, count):
+        self.minimum = min(self.minimum, minimum)
+        self.maximum = max(self.maximum, maximum)
+        self.sum += total
+        self.count += count
+
+    def merge(self, other: "_Bucket"):
+        self.add(other.minimum, other.maximum, other.sum, other.count)
+
+    def frame(self):
+        """[time in ms, mean, minimum, maximum, count]"""
+        return [
+            self.timestamp / 1e6,
+            self.sum / self.count,
+            self.minimum,
+            self.maximum,
+            self.count,
+        ]
+
+
+class LiveSubscription:
+    """Live data for one connected client, aggregated to its resolution.
+
+    Completed intervals are buffered until the client takes them.
+    If the client can't keep up and more than max_pending intervals are buffered,
+    new intervals are merged into the last buffered one of their metric,
+    so the client gets a coarser resolution instead of missing data.
+    """
+
+    def __init__(self, interval_ns, max_pending=1000):
+        self.interval_ns = interval_ns
+        self.metrics = set()
+        self._max_pending = max_pending
+        # metric -> bucket of the current interval
+        self._current = {}
+        # metric -> completed buckets
+        self._pending = defaultdict(list)
+        self._pending_count = 0
+        self._available = asyncio.Event()
+
+        self.merged = 0
+
+    def set_interval(self, interval_ns):
+        if interval_ns != self.interval_ns:
+            self.interval_ns = interval_ns
+            self._current.clear()
+
+    def add(self, metric, timestamps: np.ndarray, values: np.ndarray):
+        """Add sorted values in one go, timestamps in ns"""
+        starts = timestamps - timestamps % self.interval_ns
+        first = np.flatnonzero(np.diff(starts, prepend=starts[0] - 1))
+        minima = np.minimum.reduceat(values, first)
+        maxima = np.maximum.reduceat(values, first)
+        sums = np.add.reduceat(values, first)
+        counts = np.diff(np.append(first, len(values)))
+
+        bucket = self._current.get(metric)
+        for start, minimum, maximum, total, count in zip(
+            starts[first].tolist(),
+            minima.tolist(),
+            maxima.tolist(),
+            sums.tolist(),
+            counts.tolist(),
+        ):
+            if bucket is None or start > bucket.timestamp:
+                if bucket is not None:
+                    self._complete(metric, bucket)
+                bucket = self._current[metric] = _Bucket(start)
+            # Late values are counted in the current interval
+            bucket.add(minimum, maximum, total, count)
+
+    def _complete(self, metric, bucket):
+        pending = self._pending[metric]
+        if pending and self._pending_count >= self._max_pending:
+            pending[-1].merge(bucket)
+            self.merged += 1
+        else:
+            pending.append(bucket)
+            self._pending_count += 1
+        self._available.set()
+
+    def complete_overdue(self):
+        """Complete the current intervals which ended a while ago"""
+        deadline_ns = (Timestamp.now() - COMPLETION_DELAY).posix_ns
+        for metric, bucket in list(self._current.items()):
+            if bucket.timestamp + self.interval_ns <= deadline_ns:
+                del self._current[metric]
+                self._complete(metric, bucket)
+
+    async def wait(self, timeout):
+        try:
+            await asyncio.wait_for(self._available.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    def take(self):
+        """All completed intervals as metric -> list of frames"""
+        frames = {
+            metric: [bucket.frame() for bucket in buckets]
+            for metric, buckets in self._pending.items()
+            if buckets
+        }
+        self._pending.clear()
+        self._pending_count = 0
+        self._available.clear()
+        return frames
+
+
+class LiveSink(Sink):
+    """A single subscription to the live data of MetricQ, shared by all clients.
+
+    Each metric is subscribed while at least one client wants it.
+    Subscriptions that would exceed max_metrics_per_client metrics or
+    max_metrics metrics of all clients together are rejected.
+    """
+
+    def __init__(self, *args, max_metrics=10_000, max_metrics_per_client=100, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.max_metrics = max_metrics
+        self.max_metrics_per_client = max_metrics_per_client
+        # metric -> subscriptions
+        self._subscriptions = {}
+        self._lock = asyncio.Lock()
+
+    async def update(self, subscription: LiveSubscription, metrics):
+        """Change the metrics of a subscription.
+
+        Raises ValueError if that exceeds the limits, keeping the previous metrics.
+        """
+        metrics = set(metrics)
+        if len(metrics) > self.max_metrics_per_client:
+            raise ValueError(
+                f"at most {self.max_metrics_per_client} metrics per client"
+            )
+        async with self._lock:
+            added = [
+                metric
+                for metric in metrics - subscription.metrics
+                if metric not in self._subscriptions
+            ]
+            removed = subscription.metrics - metrics
+            unused = [
+                metric
+                for metric in removed
+                if self._subscriptions[metric] == {subscription}
+            ]
+            if len(self._subscriptions) + len(added) - len(unused) > self.max_metrics:
+                raise ValueError(f"at most {self.max_metrics} metrics in total")
+            if added:
+                await self.subscribe(added, metadata=False)
+            for metric in metrics - subscription.metrics:
+                self._subscriptions.setdefault(metric, set()).add(subscription)
+            subscription.metrics = metrics
+            await self._remove(subscription, removed)
+
+    async def remove(self, subscription: LiveSubscription):
+        async with self._lock:
+            metrics, subscription.metrics = subscription.metrics, set()
+            await self._remove(subscription, metrics)
+
+    async def _remove(self, subscription, metrics):
+        unused = []
+        for metric in metrics:
+            subscriptions = self._subscriptions[metric]
+            subscriptions.discard(subscription)
+            if not subscriptions:
+                del self._subscriptions[metric]
+                unused.append(metric)
+        if unused:
+            await self.unsubscribe(unused)
+
+    @property
+    def subscribed_metrics(self):
+        return len(self._subscriptions)
+
+    async def _on_data_chunk(self, metric, data_chunk):
+        # Decode the whole chunk at once instead of calling on_data for every value
+        subscriptions = self._subscriptions.get(metric)
+        if not subscriptions:
+            return
+        timestamps = np.cumsum(
+            np.fromiter(
+                data_chunk.time_delta, dtype=np.int64, count=len(data_chunk.time_delta)
+            )
+        )
+        values = np.fromiter(
+            data_chunk.value, dtype=np.float64, count=len(data_chunk.value)
+        )
+        if len(timestamps) == 0:
+            return
+        for subscription in subscriptions:
+            subscription.add(metric, timestamps, values)
+
+    async def on_data(self, metric, timestamp: Timestamp, value):
+        for subscription in self._subscriptions.get(metric, ()):
+            subscription.add(
+                metric,
+                np.array([timestamp.posix_ns], dtype=np.int64),
+                np.array([value]),
+            )
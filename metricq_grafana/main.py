@@ -1,6 +1,8 @@
 """Main module for running http server"""
 import asyncio
 import logging
+import os
+import sys
 import traceback
 from contextlib import suppress
 
@@ -13,9 +15,23 @@ import click_log
 from aiohttp import web
 from metricq import get_logger
 
+from .cache import HistoryCache
+from .catalog import MetricCatalog
 from .client import Client
+from .compression import compression_middleware
+from .disk_cache import DiskTileStore
+from .live import LiveSink
+from .metadata import MetadataBatcher
+from .monitoring import metrics_middleware
+from .offload import TransformPool
+from .profiling import LagMonitor, Profiler, SlowCallbackRecorder
+from .request_context import request_context_middleware
+from .rollup import RollupStore
 from .routes import setup_routes
+from .scheduler import RequestScheduler
+from .serialization import get_serializer
 from .version import version
+from .workers import run_workers
 
 logger = get_logger()
 
@@ -29,10 +45,65 @@ click_completion.init()
 
 
 async def start_background_tasks(app):
+    app["loop_lag_monitor"] = LagMonitor()
+    app["loop_lag_monitor"].start()
+    if app["slow_callback_threshold"] > 0:
+        app["slow_callbacks"] = SlowCallbackRecorder(app["slow_callback_threshold"])
+        app["slow_callbacks"].install(app.loop)
+    app["history_scheduler"] = RequestScheduler(app["history_concurrency"])
     app["history_client"] = Client(
-        app["token"], app["management_url"], client_version=version
+        app["token"],
+        app["management_url"],
+        client_version=version,
+        scheduler=app["history_scheduler"],
     )
     await app["history_client"].connect()
+    store = None
+    if app["history_disk_cache_path"] is not None:
+        store = DiskTileStore(
+            app["history_disk_cache_path"], max_bytes=app["history_disk_cache_size"]
+        )
+        await app.loop.run_in_executor(None, store.open)
+        app["history_disk_cache"] = store
+    app["history_cache"] = HistoryCache(
+        app["history_client"],
+        max_points=app["history_cache_size"],
+        hot_ttl=app["history_cache_hot_ttl"],
+        store=store,
+    )
+    if app["rollup_metrics"]:
+        app["rollups"] = RollupStore(
+            app["history_client"],
+            app["history_cache"],
+            app["rollup_metrics"],
+            update_interval=app["rollup_update_interval"],
+        )
+        app["rollups"].start()
+    app["metric_catalog"] = MetricCatalog(
+        app["history_client"], refresh_interval=app["metric_catalog_refresh"]
+    )
+    if app["metric_catalog_refresh"] > 0:
+        app["metric_catalog"].start()
+    app["metadata_batcher"] = MetadataBatcher(app["history_client"])
+    if app["transform_processes"] > 0:
+        app["transform_pool"] = TransformPool(
+            app["transform_processes"], threshold=app["transform_offload_threshold"]
+        )
+    if app["live_streaming"]:
+        live_sink = LiveSink(
+            f'{app["token"]}-live',
+            app["management_url"],
+            client_version=version,
+            max_metrics=app["live_max_metrics"],
+            max_metrics_per_client=app["live_max_metrics_per_client"],
+        )
+        try:
+            await live_sink.connect()
+        except Exception as e:
+            # Not worth failing the whole server for, /live responds with 404
+            logger.error("failed to connect the live sink: {}", e)
+        else:
+            app["live_sink"] = live_sink
 
     async def watchdog():
         try:
@@ -60,21 +131,86 @@ async def start_background_tasks(app):
 
 async def cleanup_background_tasks(app):
     logger.debug("cleanup_background_tasks called")
+    with suppress(KeyError):
+        await app["loop_lag_monitor"].stop()
+    with suppress(KeyError):
+        app["slow_callbacks"].uninstall()
+    with suppress(KeyError):
+        await app["metric_catalog"].stop()
+    with suppress(KeyError):
+        await app["rollups"].stop()
     with suppress(KeyError):
         app["history_client_watchdog"].cancel()
         # If it was the watchdog who caused the "GracefulExit"
         # Then we can suppress it here, it has already done it's deed
         with suppress(web.GracefulExit):
             await app["history_client_watchdog"]
+    with suppress(KeyError):
+        await app["live_sink"].stop()
     with suppress(KeyError):
         await app["history_client"].stop()
+    with suppress(KeyError):
+        await app["history_disk_cache"].close()
+    with suppress(KeyError):
+        app["transform_pool"].shutdown()
 
 
-def create_app(loop, token, management_url, management_exchange, cors_origin):
-    app = web.Application(loop=loop)
+def create_app(
+    loop,
+    token,
+    management_url,
+    management_exchange,
+    cors_origin,
+    *,
+    history_cache_size=2_000_000,
+    history_cache_hot_ttl=5.0,
+    json_serializer="auto",
+    history_concurrency=32,
+    metric_catalog_refresh=300.0,
+    live_streaming=False,
+    live_max_metrics=10_000,
+    live_max_metrics_per_client=100,
+    history_disk_cache_path=None,
+    history_disk_cache_size=10 * 2**30,
+    transform_processes=2,
+    transform_offload_threshold=100_000,
+    slow_callback_threshold=0.1,
+    compression_min_size=1024,
+    rollup_metrics=(),
+    rollup_update_interval=60.0,
+    request_timeout=30.0,
+    admin_endpoints=False,
+):
+    app = web.Application(
+        loop=loop,
+        middlewares=[
+            request_context_middleware,
+            metrics_middleware,
+            compression_middleware,
+        ],
+    )
     app["token"] = token
     app["management_url"] = management_url
     app["management_exchange"] = management_exchange
+    app["history_cache_size"] = history_cache_size
+    app["history_cache_hot_ttl"] = history_cache_hot_ttl
+    app["json_dumps"] = get_serializer(json_serializer)
+    app["history_concurrency"] = history_concurrency
+    app["metric_catalog_refresh"] = metric_catalog_refresh
+    app["live_streaming"] = live_streaming
+    app["live_max_metrics"] = live_max_metrics
+    app["live_max_metrics_per_client"] = live_max_metrics_per_client
+    app["history_disk_cache_path"] = history_disk_cache_path
+    app["history_disk_cache_size"] = history_disk_cache_size
+    app["transform_processes"] = transform_processes
+    app["transform_offload_threshold"] = transform_offload_threshold
+    app["slow_callback_threshold"] = slow_callback_threshold
+    app["compression_min_size"] = compression_min_size
+    app["rollup_metrics"] = rollup_metrics
+    app["rollup_update_interval"] = rollup_update_interval
+    app["request_timeout"] = request_timeout
+    app["admin_endpoints"] = admin_endpoints
+    app["profiler"] = Profiler()
     app["last_perf_list"] = []
 
     app.on_startup.append(start_background_tasks)
@@ -114,6 +250,110 @@ def panic(loop, context):
 @click.option("--host", default="0.0.0.0")
 @click.option("--port", default=4000)
 @click.option("--cors-origin", default="*")
+@click.option(
+    "--history-cache-size",
+    default=2_000_000,
+    help="Maximum number of cached history data points, 0 disables the cache",
+)
+@click.option(
+    "--history-cache-hot-ttl",
+    default=5.0,
+    help="Seconds to cache the most recent history data",
+)
+@click.option(
+    "--json-serializer",
+    type=click.Choice(["auto", "orjson", "json"]),
+    default="auto",
+    help="JSON serializer for responses, auto prefers orjson if installed",
+)
+@click.option(
+    "--history-concurrency",
+    default=32,
+    help="Maximum number of concurrent requests to the database",
+)
+@click.option(
+    "--metric-catalog-refresh",
+    default=300.0,
+    help="Seconds between refreshes of the in-memory metric catalog, 0 disables it",
+)
+@click.option(
+    "--live-streaming/--no-live-streaming",
+    default=False,
+    help="Push live data from MetricQ to WebSocket clients at /live",
+)
+@click.option(
+    "--live-max-metrics",
+    default=10_000,
+    help="Maximum number of metrics subscribed for live data by all clients",
+)
+@click.option(
+    "--live-max-metrics-per-client",
+    default=100,
+    help="Maximum number of metrics a WebSocket client can subscribe to",
+)
+@click.option(
+    "--history-disk-cache",
+    "history_disk_cache_path",
+    type=click.Path(file_okay=False),
+    default=None,
+    help="Directory for caching history data that won't change anymore on disk",
+)
+@click.option(
+    "--history-disk-cache-size",
+    default=10 * 2**30,
+    help="Maximum size of the history disk cache in bytes, "
+    "split evenly between the workers, which use subdirectories",
+)
+@click.option(
+    "--workers",
+    default=1,
+    help="Number of server processes sharing the port. Each worker has its own "
+    "connection, history cache, metric catalog and live sink, so it refreshes "
+    "the catalog and subscribes to live data on its own",
+)
+@click.option(
+    "--transform-processes",
+    default=2,
+    help="Processes for transforming and serializing large responses, 0 disables them",
+)
+@click.option(
+    "--transform-offload-threshold",
+    default=100_000,
+    help="Minimum number of entries of a response to transform it in another process",
+)
+@click.option(
+    "--slow-callback-threshold",
+    default=0.1,
+    help="Seconds after which event loop callbacks are recorded as slow, 0 disables it",
+)
+@click.option(
+    "--compression-min-size",
+    default=1024,
+    help="Minimum size in bytes of responses to compress if the client accepts it",
+)
+@click.option(
+    "--rollup-metric",
+    "rollup_metrics",
+    multiple=True,
+    help="Metric to keep 1 min, 1 h and 1 d aggregates of in memory, can be repeated",
+)
+@click.option(
+    "--rollup-update-interval",
+    default=60.0,
+    help="Seconds between updates of the rollups",
+)
+@click.option(
+    "--request-timeout",
+    default=30.0,
+    help="Seconds a request may take, clients can ask for less with the "
+    "X-Request-Timeout header, 0 disables the limit. /live and /admin are not limited",
+)
+@click.option(
+    "--admin-endpoints/--no-admin-endpoints",
+    default=False,
+    help="Serve /admin/profile and /admin/slow-callbacks, which are not protected, "
+    "so only enable them if the server is not reachable by untrusted clients",
+)
 @click_log.simple_verbosity_option(logger)
 @click.version_option(version=version)
 def runserver_cmd(
@@ -125,12 +365,26 @@ def runserver_cmd(
     host,
     port,
     cors_origin,
+    history_cache_size,
+    history_cache_hot_ttl,
+    json_serializer,
+    history_concurrency,
+    metric_catalog_refresh,
+    live_streaming,
+    live_max_metrics,
+    live_max_metrics_per_client,
+    history_disk_cache_path,
+    history_disk_cache_size,
+    workers,
+    transform_processes,
+    transform_offload_threshold,
+    slow_callback_threshold,
+    compression_min_size,
+    rollup_metrics,
+    rollup_update_interval,
+    request_timeout,
+    admin_endpoints,
 ):
-    loop = asyncio.get_event_loop()
-    if debug:
-        logger.warn("Using loop debug - this is slow")
-        loop.set_debug(True)
-
     if log_to_journal:
         try:
             from systemd import journal
@@ -139,5 +393,69 @@ def runserver_cmd(
         except ImportError:
             logger.error("Can't enable journal logger, systemd package not found!")
 
-    app = create_app(loop, token, management_url, management_exchange, cors_origin)
-    web.run_app(app, host=host, port=int(port), loop=loop)
+    def serve(token, reuse_port=None, worker=None):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        if debug:
+            logger.warn("Using loop debug - this is slow")
+            loop.set_debug(True)
+
+        disk_cache_path = history_disk_cache_path
+        disk_cache_size = history_disk_cache_size
+        if worker is not None and disk_cache_path is not None:
+            # Each disk cache keeps its own index and evicts on its own,
+            # so the workers can't share one
+            disk_cache_path = os.path.join(disk_cache_path, f"worker-{worker}")
+            disk_cache_size //= workers
+
+        app = create_app(
+            loop,
+            token,
+            management_url,
+            management_exchange,
+            cors_origin,
+            history_cache_size=history_cache_size,
+            history_cache_hot_ttl=history_cache_hot_ttl,
+            json_serializer=json_serializer,
+            history_concurrency=history_concurrency,
+            metric_catalog_refresh=metric_catalog_refresh,
+            live_streaming=live_streaming,
+            live_max_metrics=live_max_metrics,
+            live_max_metrics_per_client=live_max_metrics_per_client,
+            history_disk_cache_path=disk_cache_path,
+            history_disk_cache_size=disk_cache_size,
+            transform_processes=transform_processes,
+            transform_offload_threshold=transform_offload_threshold,
+            slow_callback_threshold=slow_callback_threshold,
+            compression_min_size=compression_min_size,
+            rollup_metrics=rollup_metrics,
+            rollup_update_interval=rollup_update_interval,
+            request_timeout=request_timeout,
+            admin_endpoints=admin_endpoints,
+        )
+        # Stop working on requests whose client went away
+        web.run_app(
+            app,
+            host=host,
+            port=int(port),
+            loop=loop,
+            reuse_port=reuse_port,
+            handler_cancellation=True,
+        )
+
+    if workers > 1 and rollup_metrics:
+        # Every worker would request the whole retention of every tier
+        raise click.UsageError(
+            "--rollup-metric can't be used with --workers, "
+            "each worker would build the rollups from the database on its own"
+        )
+
+    if workers > 1:
+        # Each worker needs its own token to get its own queues
+        sys.exit(
+            run_workers(
+                workers,
+                lambda index: serve(f"{token}-{index}", reuse_port=True, worker=index),
+            )
+        )
+    serve(token)
@@ -0,0 +1,67 @@
+"""Module for batched metadata lookups"""
+import asyncio
+
+from metricq import get_logger
+
+logger = get_logger(__name__)
+
+
+class MetadataBatcher:
+    """Collects metadata lookups and resolves them with a single request to the manager.
+
+    Lookups arriving within `delay` seconds of the first one end up in the same batch,
+    e.g. those of all targets of a query.
+    """
+
+    def __init__(self, client, delay=0.005, max_batch_size=1000):
+        self._client = client
+        self._delay = delay
+        self._max_batch_size = max_batch_size
+        # metric -> future of its metadata
+        self._pending = {}
+        self._flush_handle = None
+
+        self.lookups = 0
+        self.batches = 0
+
+    async def get(self, metric):
+        """Metadata of the metric, None if the manager doesn't know it"""
+        self.lookups += 1
+        try:
+            future = self._pending[metric]
+        except KeyError:
+            future = asyncio.get_running_loop().create_future()
+            self._pending[metric] = future
+            if len(self._pending) >= self._max_batch_size:
+                self._flush()
+            elif self._flush_handle is None:
+                self._flush_handle = asyncio.get_running_loop().call_later(
+                    self._delay, self._flush
+                )
+
+        # A cancelled caller must not cancel the lookup for all the others
+        metadata = await asyncio.shield(future)
+        return None if metadata is None else dict(metadata)
+
+    def _flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        batch, self._pending = self._pending, {}
+        self.batches += 1
+        asyncio.ensure_future(self._resolve(batch))
+
+    async def _resolve(self, batch):
+        logger.debug("requesting metadata for {} metrics", len(batch))
+        try:
+            result = await self._client.get_metrics(selector=list(batch), metadata=True)
+        except Exception as e:
+            for future in batch.values():
+                if not future.done():
+                    future.set_exception(e)
+                    # Mark the exception as retrieved, even if every caller is gone
+                    future.exception()
+            return
+        for metric, future in batch.items():
+            if not future.done():
+                future.set_result(result.get(metric))
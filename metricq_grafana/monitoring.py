@@ -0,0 +1,430 @@
+"""Module for metrics about this service itself, exposed in the Prometheus text format"""
+import asyncio
+import math
+import time
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+
+from aiohttp import web
+
+from .request_context import current_request
+
+timer = time.perf_counter
+
+DEFAULT_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+)
+
+
+def _format_value(value):
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value))
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (
+        (name, str(value).replace("\\", r"\\").replace("\n", r"\n").replace('"', r"\""))
+        for name, value in labels
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+def format_metric(name, metric_type, documentation, samples):
+    """Lines of one metric family, samples are (suffix, labels, value) tuples"""
+    yield f"# HELP {name} {documentation}"
+    yield f"# TYPE {name} {metric_type}"
+    for suffix, labels, value in samples:
+        yield f"{name}{suffix}{_format_labels(labels)} {_format_value(value)}"
+
+
+class _Metric(ABC):
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+
+    def labels(self, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        try:
+            return self._children[key]
+        except KeyError:
+            child = self._children[key] = self._new_child()
+            return child
+
+    @abstractmethod
+    def _new_child(self):
+        pass
+
+    def render(self):
+        samples = []
+        for key, child in sorted(self._children.items()):
+            labels = list(zip(self.labelnames, key))
+            samples.extend(
+                (suffix, labels + extra_labels, value)
+                for suffix, extra_labels, value in child.samples()
+            )
+        return format_metric(self.name, self.type, self.documentation, samples)
+
+
+class _CounterValue:
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self):
+        yield "", [], self.value
+
+
+class _GaugeValue(_CounterValue):
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def set(self, value):
+        self.value = value
+
+
+class _HistogramValue:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+                break
+
+    @contextmanager
+    def time(self):
+        begin = timer()
+        try:
+            yield
+        finally:
+            self.observe(timer() - begin)
+
+    def samples(self):
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            yield "_bucket", [("le", _format_value(bound))], cumulative
+        yield "_bucket", [("le", "+Inf")], self.count
+        yield "_sum", [], self.sum
+        yield "_count", [], self.count
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def _new_child(self):
+        return _CounterValue()
+
+
+class Gauge(_Metric):
+    type = "gauge"
+
+    def _new_child(self):
+        return _GaugeValue()
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_child(self):
+        return _HistogramValue(self.buckets)
+
+
+class Registry:
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self._metrics = []
+
+    def _register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(
+            Counter(f"{self.prefix}_{name}", documentation, labelnames)
+        )
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._register(Gauge(f"{self.prefix}_{name}", documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(
+            Histogram(f"{self.prefix}_{name}", documentation, labelnames, buckets)
+        )
+
+    def render(self):
+        for metric in self._metrics:
+            yield from metric.render()
+
+
+class ServiceMetrics(Registry):
+    """All metrics of the service, stages of a request are labeled by endpoint"""
+
+    def __init__(self, prefix="metricq_grafana"):
+        super().__init__(prefix)
+        self.requests_in_flight = self.gauge(
+            "http_requests_in_flight", "HTTP requests being processed", ["endpoint"]
+        )
+        self.request_duration = self.histogram(
+            "http_request_duration_seconds",
+            "Total duration of HTTP requests",
+            ["endpoint", "status"],
+        )
+        self.parse_duration = self.histogram(
+            "request_parse_seconds", "Parsing the JSON request body", ["endpoint"]
+        )
+        self.scheduler_wait = self.histogram(
+            "scheduler_wait_seconds",
+            "Waiting for a free slot to send a history request",
+            ["endpoint"],
+        )
+        self.amqp_wait = self.histogram(
+            "amqp_wait_seconds",
+            "Waiting for the response to a history request",
+            ["endpoint"],
+        )
+        self.db_duration = self.histogram(
+            "db_duration_seconds",
+            "Duration of history requests as reported by the database",
+            ["endpoint"],
+        )
+        self.transform_duration = self.histogram(
+            "transform_seconds",
+            "Applying a function to history data",
+            ["endpoint", "function"],
+        )
+        self.serialization_duration = self.histogram(
+            "serialization_seconds", "Serializing the response", ["endpoint"]
+        )
+        self.offload_duration = self.histogram(
+            "offload_seconds",
+            "Transforming and serializing a large response in the transform pool",
+            ["endpoint"],
+        )
+        self.compression_duration = self.histogram(
+            "compression_seconds", "CPU time for compressing a response", ["encoding"]
+        )
+        self.loop_lag = self.histogram(
+            "event_loop_lag_seconds", "Delay of the event loop waking up a task"
+        )
+        self.slow_callbacks = self.counter(
+            "slow_callbacks_total",
+            "Callbacks blocking the event loop longer than the threshold",
+            ["endpoint"],
+        )
+        self.timeouts = self.counter(
+            "timeouts_total", "Requests to the database that timed out", ["endpoint"]
+        )
+        self.cancelled_requests = self.counter(
+            "cancelled_requests_total",
+            "Requests cancelled because the client went away",
+            ["endpoint"],
+        )
+        self.expired_requests = self.counter(
+            "expired_requests_total",
+            "Requests that ran out of time, answered partially or not at all",
+            ["endpoint"],
+        )
+
+
+metrics = ServiceMetrics()
+
+
+def current_endpoint():
+    context = current_request.get()
+    return "" if context is None else context.endpoint
+
+
+@web.middleware
+async def metrics_middleware(request, handler):
+    resource = request.match_info.route.resource
+    # Don't create a new series for every path that is not found
+    endpoint = "unmatched" if resource is None else resource.canonical
+    in_flight = metrics.requests_in_flight.labels(endpoint=endpoint)
+    in_flight.inc()
+    status = 500
+    begin = timer()
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    except asyncio.CancelledError:
+        # Like nginx, for the duration of requests the client closed
+        status = 499
+        metrics.cancelled_requests.labels(endpoint=endpoint).inc()
+        raise
+    finally:
+        in_flight.dec()
+        context = current_request.get()
+        if status != 499 and context is not None and context.expired:
+            # Answered with whatever was complete by then, or not at all
+            metrics.expired_requests.labels(endpoint=endpoint).inc()
+        metrics.request_duration.labels(endpoint=endpoint, status=status).observe(
+            timer() - begin
+        )
+
+
+def _stat(name, metric_type, documentation, value):
+    return format_metric(
+        f"{metrics.prefix}_{name}", metric_type, documentation, [("", [], value)]
+    )
+
+
+def collect_app_stats(app):
+    """Lines for the statistics kept by the components of the app"""
+    if "history_cache" in app:
+        cache = app["history_cache"]
+        yield from _stat(
+            "history_cache_hits_total", "counter", "History cache tile hits", cache.hits
+        )
+        yield from _stat(
+            "history_cache_misses_total",
+            "counter",
+            "History cache tile misses",
+            cache.misses,
+        )
+        yield from _stat(
+            "history_cache_tail_refreshes_total",
+            "counter",
+            "Hot tiles updated by requesting only their most recent data",
+            cache.tail_refreshes,
+        )
+    if "history_disk_cache" in app:
+        store = app["history_disk_cache"]
+        yield from _stat(
+            "history_disk_cache_hits_total",
+            "counter",
+            "History disk cache tile hits",
+            store.hits,
+        )
+        yield from _stat(
+            "history_disk_cache_misses_total",
+            "counter",
+            "History disk cache tile misses",
+            store.misses,
+        )
+        yield from _stat(
+            "history_disk_cache_bytes",
+            "gauge",
+            "Size of the history disk cache",
+            store.bytes,
+        )
+    if "history_client" in app:
+        client = app["history_client"]
+        yield from _stat(
+            "history_requests_total",
+            "counter",
+            "History requests, including coalesced ones",
+            client.history_requests,
+        )
+        yield from _stat(
+            "history_requests_coalesced_total",
+            "counter",
+            "History requests served by an identical one in flight",
+            client.coalesced_history_requests,
+        )
+        yield from _stat(
+            "history_requests_cancelled_total",
+            "counter",
+            "History requests cancelled because all of their callers were gone",
+            client.cancelled_history_requests,
+        )
+    if "history_scheduler" in app:
+        scheduler = app["history_scheduler"]
+        yield from _stat(
+            "scheduler_queue_depth",
+            "gauge",
+            "History requests waiting for a slot",
+            scheduler.queue_depth,
+        )
+        yield from _stat(
+            "scheduler_active",
+            "gauge",
+            "History requests holding a slot",
+            scheduler.active,
+        )
+        yield from _stat(
+            "scheduler_scheduled_total",
+            "counter",
+            "History requests that got a slot",
+            scheduler.scheduled,
+        )
+    if "rollups" in app:
+        yield from _stat(
+            "rollup_hits_total",
+            "counter",
+            "Timelines and aggregates answered from rollups",
+            app["rollups"].hits,
+        )
+    if "transform_pool" in app:
+        yield from _stat(
+            "transform_pool_offloaded_total",
+            "counter",
+            "Responses transformed and serialized in the transform pool",
+            app["transform_pool"].offloaded,
+        )
+    if "metric_catalog" in app:
+        yield from _stat(
+            "metric_catalog_metrics",
+            "gauge",
+            "Metrics in the metric catalog",
+            len(app["metric_catalog"]),
+        )
+    if "live_sink" in app:
+        yield from _stat(
+            "live_subscribed_metrics",
+            "gauge",
+            "Metrics subscribed for live data",
+            app["live_sink"].subscribed_metrics,
+        )
+    if "metadata_batcher" in app:
+        batcher = app["metadata_batcher"]
+        yield from _stat(
+            "metadata_lookups_total",
+            "counter",
+            "Metadata lookups not answered by the metric catalog",
+            batcher.lookups,
+        )
+        yield from _stat(
+            "metadata_batches_total",
+            "counter",
+            "Batched metadata requests sent to the manager",
+            batcher.batches,
+        )
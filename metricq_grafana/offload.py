@@ -0,0 +1,36 @@
+"""Module for running CPU-heavy work on large responses in worker processes"""
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+
+class TransformPool:
+    """Process pool for transforming and serializing large responses.
+
+    Small responses are handled faster on the event loop than by sending them
+    to another process, so only responses with at least threshold entries
+    are offloaded.
+    Functions and arguments are pickled, so they must be defined at module level
+    and the arguments should be compact, i.e. arrays instead of lists of objects.
+    """
+
+    def __init__(self, processes, threshold):
+        self.threshold = threshold
+        # Forking a process with a running event loop and connections is unsafe
+        self._executor = ProcessPoolExecutor(
+            processes, mp_context=multiprocessing.get_context("spawn")
+        )
+
+        self.offloaded = 0
+
+    def offloads(self, size):
+        return size >= self.threshold
+
+    async def run(self, function, *args):
+        self.offloaded += 1
+        return await asyncio.get_running_loop().run_in_executor(
+            self._executor, function, *args
+        )
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
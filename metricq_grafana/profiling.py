@@ -0,0 +1,201 @@
+"""Lightweight instruments for the event loop, cheap enough to be always on.
+
+Unlike the debug mode of asyncio, which slows down the whole loop.
+"""
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter, deque
+from typing import Optional
+
+from metricq import get_logger
+
+from .monitoring import metrics
+from .request_context import current_request, current_target
+
+logger = get_logger(__name__)
+
+timer = time.perf_counter
+
+
+class LagMonitor:
+    """Samples how late the event loop wakes up a sleeping task"""
+
+    def __init__(self, interval=0.25):
+        self.interval = interval
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+    async def _run(self):
+        while True:
+            begin = timer()
+            await asyncio.sleep(self.interval)
+            lag = timer() - begin - self.interval
+            metrics.loop_lag.labels().observe(max(lag, 0.0))
+
+
+class SlowCallbackRecorder:
+    """Records callbacks of the event loop that run longer than threshold seconds.
+
+    Each record contains the endpoint and metric of the request on whose behalf
+    the callback ran, taken from the context of the callback.
+    In debug mode, the loop measures its callbacks itself and reports slow ones
+    via the asyncio logger, without the request.
+    Otherwise, only the event loops of asyncio can be instrumented, e.g. not uvloop.
+    """
+
+    def __init__(self, threshold=0.1, max_records=100):
+        self.threshold = threshold
+        self.records = deque(maxlen=max_records)
+        self._original_run = None
+        self._log_handler = None
+
+    def install(self, loop):
+        if loop.get_debug():
+            loop.slow_callback_duration = self.threshold
+            self._log_handler = _SlowCallbackLogHandler(self)
+            logging.getLogger("asyncio").addHandler(self._log_handler)
+            return
+        if not isinstance(loop, asyncio.BaseEventLoop):
+            logger.warning(
+                "not recording slow callbacks, {} is not supported without --debug",
+                type(loop).__name__,
+            )
+            return
+
+        # The event loop runs every callback and every step of a task via Handle._run
+        # This is private API, but the public one requires the slow debug mode.
+        original_run = self._original_run = asyncio.events.Handle._run
+        recorder = self
+
+        def _run(handle):
+            # The callback may leave the context, e.g. at the end of a request
+            context = handle._context
+            request = context.get(current_request)
+            target = context.get(current_target)
+            begin = timer()
+            try:
+                return original_run(handle)
+            finally:
+                duration = timer() - begin
+                if duration >= recorder.threshold:
+                    recorder._record(repr(handle), duration, request, target)
+
+        asyncio.events.Handle._run = _run
+
+    def uninstall(self):
+        if self._original_run is not None:
+            asyncio.events.Handle._run = self._original_run
+            self._original_run = None
+        if self._log_handler is not None:
+            logging.getLogger("asyncio").removeHandler(self._log_handler)
+            self._log_handler = None
+
+    def _record(self, callback, duration, request, target, log=True):
+        endpoint = "" if request is None else request.endpoint
+        record = {
+            "time": time.time(),
+            "duration": duration,
+            "endpoint": endpoint,
+            "request": None if request is None else request.id,
+            "target": target,
+            "callback": callback,
+        }
+        self.records.append(record)
+        metrics.slow_callbacks.labels(endpoint=endpoint).inc()
+        if not log:
+            return
+        logger.warning(
+            "slow callback took {:.3f} s (endpoint: {}, target: {}): {}",
+            duration,
+            endpoint or None,
+            target,
+            record["callback"],
+        )
+
+
+class _SlowCallbackLogHandler(logging.Handler):
+    """Records the slow callbacks reported by asyncio in debug mode"""
+
+    def __init__(self, recorder: SlowCallbackRecorder):
+        super().__init__(logging.WARNING)
+        self._recorder = recorder
+
+    def emit(self, record):
+        # "Executing %s took %.3f seconds" with the callback and the duration
+        if record.msg.startswith("Executing ") and len(record.args) == 2:
+            callback, duration = record.args
+            # Already logged by asyncio
+            self._recorder._record(str(callback), duration, None, None, log=False)
+
+
+def _frame_name(frame):
+    code = frame.f_code
+    return (
+        f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+    )
+
+
+def sample_stacks(thread_id, duration, interval=0.005) -> Counter:
+    """Sample the stack of a thread, returns the number of samples per stack.
+
+    Stacks are tuples of frame names, outermost first.
+    Meant to be run in another thread than the sampled one.
+    """
+    samples = Counter()
+    end = timer() + duration
+    while timer() < end:
+        frame = sys._current_frames().get(thread_id)
+        if frame is None:
+            break
+        stack = []
+        while frame is not None:
+            stack.append(_frame_name(frame))
+            frame = frame.f_back
+        samples[tuple(reversed(stack))] += 1
+        time.sleep(interval)
+    return samples
+
+
+def fold_stacks(samples: Counter) -> str:
+    """Folded stacks as read by flamegraph.pl, speedscope and others"""
+    return "".join(
+        f"{';'.join(stack)} {count}\n" for stack, count in sorted(samples.items())
+    )
+
+
+class Profiler:
+    """Time-boxed sampling profiles of the event loop thread, one at a time"""
+
+    MAX_DURATION = 60
+
+    def __init__(self):
+        self.running = False
+
+    async def profile(self, duration, interval=0.005) -> str:
+        if self.running:
+            raise RuntimeError("a profile is already running")
+        self.running = True
+        try:
+            # Called from the event loop, so this is the thread to sample
+            thread_id = threading.get_ident()
+            samples = await asyncio.get_running_loop().run_in_executor(
+                None,
+                sample_stacks,
+                thread_id,
+                min(duration, self.MAX_DURATION),
+                interval,
+            )
+        finally:
+            self.running = False
+        return fold_stacks(samples)
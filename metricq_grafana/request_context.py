@@ -0,0 +1,111 @@
+"""Module for context information about the HTTP request being processed"""
+import itertools
+import time
+from contextvars import ContextVar
+from typing import Optional
+
+from aiohttp import web
+
+# Lower values are scheduled first
+PRIORITY_INTERACTIVE = 0
+PRIORITY_DEFAULT = 1
+PRIORITY_BACKGROUND = 2
+
+ENDPOINT_PRIORITIES = {
+    "/query": PRIORITY_INTERACTIVE,
+    "/timeline": PRIORITY_INTERACTIVE,
+    "/analyze": PRIORITY_BACKGROUND,
+}
+
+# Endpoints that take as long as the client wants them to, such as WebSockets
+ENDPOINTS_WITHOUT_DEADLINE = {"/live", "/admin/profile", "/admin/slow-callbacks"}
+
+# Seconds a client may ask a request to be answered within
+REQUEST_TIMEOUT_HEADER = "X-Request-Timeout"
+
+_request_ids = itertools.count()
+
+current_request: ContextVar[Optional["RequestContext"]] = ContextVar(
+    "current_request", default=None
+)
+# The metric that is being processed within the request, if any
+current_target: ContextVar[Optional[str]] = ContextVar("current_target", default=None)
+
+
+class RequestContext:
+    """Who is asking for what, available to everything running on behalf of a request"""
+
+    def __init__(self, endpoint, client, priority=PRIORITY_DEFAULT, budget=None):
+        self.id = next(_request_ids)
+        self.endpoint = endpoint
+        self.client = client
+        self.priority = priority
+        # In time.monotonic(), None if the request may take as long as it takes
+        self.deadline = None if budget is None else time.monotonic() + budget
+
+    def remaining(self) -> Optional[float]:
+        """Seconds left until the deadline, None without a deadline"""
+        if self.deadline is None:
+            return None
+        return max(self.deadline - time.monotonic(), 0.0)
+
+    @property
+    def expired(self):
+        return self.deadline is not None and time.monotonic() >= self.deadline
+
+    @classmethod
+    def from_request(cls, request: web.Request) -> "RequestContext":
+        # Grafana forwards the user if the data source is configured to do so
+        client = request.headers.get("X-Grafana-User", request.remote)
+        return cls(
+            endpoint=request.path,
+            client=client,
+            priority=ENDPOINT_PRIORITIES.get(request.path, PRIORITY_DEFAULT),
+            budget=_budget(request),
+        )
+
+
+def _budget(request: web.Request) -> Optional[float]:
+    """The configured budget of the request, unless the client asks for less"""
+    if request.path in ENDPOINTS_WITHOUT_DEADLINE:
+        return None
+    budgets = []
+    if request.app.get("request_timeout"):
+        budgets.append(request.app["request_timeout"])
+    try:
+        requested = float(request.headers[REQUEST_TIMEOUT_HEADER])
+    except (KeyError, ValueError):
+        pass
+    else:
+        if requested > 0:
+            budgets.append(requested)
+    return min(budgets, default=None)
+
+
+def request_timeout(timeout: Optional[float]) -> Optional[float]:
+    """The timeout for something done on behalf of the current request:
+    the given one, but no longer than the time left until its deadline
+    """
+    context = current_request.get()
+    remaining = None if context is None else context.remaining()
+    if remaining is None:
+        return timeout
+    return remaining if timeout is None else min(timeout, remaining)
+
+
+async def for_target(metric, awaitable):
+    """Await something on behalf of a single metric of the current request"""
+    token = current_target.set(metric)
+    try:
+        return await awaitable
+    finally:
+        current_target.reset(token)
+
+
+@web.middleware
+async def request_context_middleware(request, handler):
+    token = current_request.set(RequestContext.from_request(request))
+    try:
+        return await handler(request)
+    finally:
+        current_request.reset(token)
@@ -0,0 +1,70 @@
+"""Module for choosing the resolution of history requests"""
+import bisect
+from typing import NamedTuple, Optional
+
+from metricq.history_client import HistoryRequestType
+from metricq.types import Timedelta, Timestamp
+
+_SECOND = 10**9
+_MINUTE = 60 * _SECOND
+_HOUR = 60 * _MINUTE
+_DAY = 24 * _HOUR
+
+# All requests use one of these intervals (in ns), so that they can share caches
+CANONICAL_INTERVALS = tuple(
+    [step * 10**exponent for exponent in range(9) for step in (1, 2, 5)]
+    + [count * _SECOND for count in (1, 2, 5, 10, 15, 30)]
+    + [count * _MINUTE for count in (1, 2, 5, 10, 15, 30)]
+    + [count * _HOUR for count in (1, 2, 3, 6, 12)]
+    + [count * _DAY for count in (1, 2, 7, 14, 30)]
+)
+
+
+def canonical_interval(interval: Timedelta) -> Timedelta:
+    """The largest canonical interval that is not coarser than the given one"""
+    index = bisect.bisect_right(CANONICAL_INTERVALS, interval.ns)
+    return Timedelta(CANONICAL_INTERVALS[max(index - 1, 0)])
+
+
+def metric_rate(metadata) -> Optional[float]:
+    """The rate of the metric in Hz according to its metadata, if known"""
+    try:
+        rate = float(metadata["rate"])
+    except (KeyError, TypeError, ValueError):
+        return None
+    return rate if rate > 0 else None
+
+
+class Resolution(NamedTuple):
+    interval: Timedelta
+    request_type: HistoryRequestType
+
+
+def plan_resolution(
+    start_time: Timestamp,
+    end_time: Timestamp,
+    max_points,
+    rate: Optional[float] = None,
+) -> Resolution:
+    """Choose interval and request type for showing about max_points points.
+
+    Without knowing the rate of the metric, the database decides between
+    raw values and aggregates.
+    If the metric has clearly more values than max_points in the range,
+    aggregates are requested right away, so that the database doesn't have to
+    count the values and all parts of the range consistently return aggregates.
+    """
+    duration = end_time - start_time
+    interval = canonical_interval(duration / max(max_points, 1))
+    if rate is not None and duration.s * rate > max_points:
+        return Resolution(interval, HistoryRequestType.AGGREGATE_TIMELINE)
+    return Resolution(interval, HistoryRequestType.FLEX_TIMELINE)
+
+
+def plan_metric_resolution(
+    catalog, metric, start_time, end_time, max_points
+) -> Resolution:
+    """Like :func:`plan_resolution` with the rate of the metric from the catalog"""
+    metadata = catalog.metadata(metric)
+    rate = None if metadata is None else metric_rate(metadata)
+    return plan_resolution(start_time, end_time, max_points, rate)
@@ -0,0 +1,317 @@
+"""Precomputed aggregates of selected metrics for long ranges.
+
+For each configured metric, dense aggregates at fixed tiers (1 min, 1 h, 1 d)
+are kept in memory and updated in the background with only the intervals
+completed since the last update.
+Long-range timelines are assembled from these bins, and whole-range aggregates
+are merged from them, so the database only has to provide the short edges.
+Bins are assembled from database aggregates of a tenth of the tier, which
+are attributed to the bin they start in.
+"""
+import asyncio
+from contextlib import suppress
+from typing import NamedTuple, Optional
+
+import numpy as np
+from metricq import get_logger
+from metricq.history_client import HistoryRequestType, HistoryResponseType
+from metricq.types import TimeAggregate, Timedelta, Timestamp
+
+from .cache import HOT_TILE_SETTLE_TIME
+from .history_data import Aggregates, HistoryData
+from .request_context import PRIORITY_BACKGROUND, RequestContext, current_request
+
+logger = get_logger(__name__)
+
+
+class Tier(NamedTuple):
+    interval: Timedelta
+    retention: Timedelta
+
+
+TIERS = (
+    Tier(Timedelta.from_s(60), Timedelta.from_s(7 * 24 * 3600)),
+    Tier(Timedelta.from_s(3600), Timedelta.from_s(366 * 24 * 3600)),
+    Tier(Timedelta.from_s(24 * 3600), Timedelta.from_s(10 * 366 * 24 * 3600)),
+)
+# Bins are assembled from database aggregates of 1 / SOURCE_RESOLUTION of the tier
+SOURCE_RESOLUTION = 10
+
+
+def _reduce(columns: Aggregates, group_ids: np.ndarray, timestamps) -> Aggregates:
+    """Merge consecutive aggregates with the same (sorted) group id"""
+    starts = np.flatnonzero(np.diff(group_ids, prepend=group_ids[:1] - 1))
+    return Aggregates(
+        timestamp=timestamps,
+        minimum=np.minimum.reduceat(columns.minimum, starts),
+        maximum=np.maximum.reduceat(columns.maximum, starts),
+        sum=np.add.reduceat(columns.sum, starts),
+        count=np.add.reduceat(columns.count, starts),
+        integral_ns=np.add.reduceat(columns.integral_ns, starts),
+        active_time=np.add.reduceat(columns.active_time, starts),
+    )
+
+
+def _empty_bins(count) -> Aggregates:
+    return Aggregates(
+        timestamp=np.empty(count, dtype=np.int64),
+        minimum=np.full(count, np.inf),
+        maximum=np.full(count, -np.inf),
+        sum=np.zeros(count),
+        count=np.zeros(count, dtype=np.int64),
+        integral_ns=np.zeros(count),
+        active_time=np.zeros(count, dtype=np.int64),
+    )
+
+
+class _Rollup:
+    """Dense aggregates of one metric at one tier.
+
+    Bin i covers [begin_ns + i * interval_ns, begin_ns + (i + 1) * interval_ns).
+    Bins without values have a count of 0.
+    """
+
+    def __init__(self, tier: Tier):
+        self.interval_ns = tier.interval.ns
+        self.retention_ns = tier.retention.ns
+        self.begin_ns = None
+        self.bins: Optional[Aggregates] = None
+
+    @property
+    def end_ns(self):
+        return self.begin_ns + len(self.bins.timestamp) * self.interval_ns
+
+    def extend(self, begin_ns, end_ns, aggregates: Aggregates):
+        """Add the bins in [begin_ns, end_ns), which must follow the existing ones"""
+        count = (end_ns - begin_ns) // self.interval_ns
+        bins = _empty_bins(count)
+        bins.timestamp[:] = begin_ns + np.arange(count) * self.interval_ns
+        index = (aggregates.timestamp - begin_ns) // self.interval_ns
+        inside = (index >= 0) & (index < count)
+        if np.any(inside):
+            index = index[inside]
+            merged = _reduce(
+                Aggregates(*(column[inside] for column in aggregates)),
+                index,
+                timestamps=None,
+            )
+            positions = np.unique(index)
+            for name in Aggregates._fields[1:]:
+                getattr(bins, name)[positions] = getattr(merged, name)
+
+        if self.bins is None:
+            self.begin_ns, self.bins = begin_ns, bins
+        else:
+            self.bins = Aggregates(*map(np.concatenate, zip(self.bins, bins)))
+        expired = max(
+            (end_ns - self.retention_ns - self.begin_ns) // self.interval_ns, 0
+        )
+        if expired:
+            self.begin_ns += expired * self.interval_ns
+            self.bins = Aggregates(*(column[expired:] for column in self.bins))
+
+    def covered(self, start_ns, end_ns):
+        """The largest range of complete bins within [start_ns, end_ns)"""
+        first = max(-(-start_ns // self.interval_ns) * self.interval_ns, self.begin_ns)
+        last = min(end_ns // self.interval_ns * self.interval_ns, self.end_ns)
+        return first, max(first, last)
+
+    def slice(self, start_ns, end_ns) -> Aggregates:
+        """The bins within [start_ns, end_ns), which must be bin boundaries"""
+        first = (start_ns - self.begin_ns) // self.interval_ns
+        last = (end_ns - self.begin_ns) // self.interval_ns
+        return Aggregates(*(column[first:last] for column in self.bins))
+
+
+class RollupStore:
+    """Rollups of the given metrics, updated every update_interval seconds"""
+
+    def __init__(self, client, cache, metrics, update_interval=60):
+        self._client = client
+        self._cache = cache
+        self._update_interval = update_interval
+        # metric -> rollups, finest tier first
+        self._rollups = {
+            metric: [_Rollup(tier) for tier in TIERS] for metric in metrics
+        }
+        self._task = None
+
+        self.hits = 0
+
+    def start(self):
+        self._task = asyncio.ensure_future(self._update_periodically())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        with suppress(asyncio.CancelledError):
+            await self._task
+
+    async def _update_periodically(self):
+        # Dashboards are more important than keeping the rollups up to date
+        current_request.set(
+            RequestContext("rollup", "rollup", priority=PRIORITY_BACKGROUND)
+        )
+        while True:
+            for metric, rollups in self._rollups.items():
+                for rollup in rollups:
+                    try:
+                        await self._update(metric, rollup)
+                    except Exception as e:
+                        logger.error("failed to update rollup of {}: {}", metric, e)
+            await asyncio.sleep(self._update_interval)
+
+    async def _update(self, metric, rollup: _Rollup):
+        settled_ns = (Timestamp.now() - HOT_TILE_SETTLE_TIME).posix_ns
+        end_ns = settled_ns // rollup.interval_ns * rollup.interval_ns
+        if rollup.bins is None:
+            begin_ns = end_ns - rollup.retention_ns
+        else:
+            begin_ns = rollup.end_ns
+        if begin_ns >= end_ns:
+            return
+
+        response = await self._client.history_data_request(
+            metric,
+            Timestamp(begin_ns),
+            Timestamp(end_ns),
+            Timedelta(rollup.interval_ns // SOURCE_RESOLUTION),
+            request_type=HistoryRequestType.AGGREGATE_TIMELINE,
+            timeout=60,
+        )
+        aggregates = HistoryData.from_response(response).aggregates(convert=True)
+        rollup.extend(begin_ns, end_ns, aggregates)
+        logger.debug(
+            "updated {} s rollup of {} up to {}",
+            rollup.interval_ns / 1e9,
+            metric,
+            Timestamp(end_ns),
+        )
+
+    async def history_data_request(
+        self,
+        metric,
+        start_time: Timestamp,
+        end_time: Timestamp,
+        interval: Timedelta,
+        request_type=HistoryRequestType.FLEX_TIMELINE,
+        timeout=60,
+    ) -> Optional[HistoryData]:
+        """Aggregates of the metric from its rollups and the history cache for the
+        most recent part, None if there are no suitable rollups.
+        """
+        start_ns, end_ns = start_time.posix_ns, end_time.posix_ns
+        usable = [
+            rollup
+            for rollup in self._rollups.get(metric, ())
+            if rollup.bins is not None and rollup.interval_ns <= interval.ns
+            # Like the database, include one interval before the start
+            and rollup.begin_ns <= start_ns - interval.ns < rollup.end_ns
+        ]
+        if not usable:
+            return None
+        rollup = usable[-1]
+
+        # Multiples of the tier, aligned like the intervals of the database
+        group_ns = interval.ns // rollup.interval_ns * rollup.interval_ns
+        first_ns = (start_ns - group_ns) // group_ns * group_ns
+        last_ns = min(end_ns + group_ns, rollup.end_ns) // group_ns * group_ns
+        first_ns = -(-max(first_ns, rollup.begin_ns) // group_ns) * group_ns
+        if last_ns <= first_ns:
+            return None
+        bins = rollup.slice(first_ns, last_ns)
+        group_ids = bins.timestamp // group_ns
+        aggregates = _reduce(bins, group_ids, np.unique(group_ids) * group_ns)
+        if (
+            request_type is HistoryRequestType.FLEX_TIMELINE
+            and aggregates.count.sum() < len(aggregates.timestamp)
+        ):
+            # The database would return the raw values
+            return None
+
+        data = HistoryData(HistoryResponseType.AGGREGATES, 0.0, aggregates=aggregates)
+        if last_ns < end_ns:
+            tail = await self._cache.history_data_request(
+                metric,
+                Timestamp(last_ns),
+                end_time,
+                interval,
+                request_type=HistoryRequestType.AGGREGATE_TIMELINE,
+                timeout=timeout,
+            )
+            if tail is None:
+                return None
+            data = HistoryData.concatenate([data, tail], tail.request_duration)
+            if data is None:
+                return None
+        self.hits += 1
+        return data.trim(start_ns, end_ns)
+
+    async def aggregate(
+        self, metric, start_time: Timestamp, end_time: Timestamp, timeout=30
+    ) -> Optional[TimeAggregate]:
+        """Aggregate of the metric over the range, merged from the rollups and
+        the database for the edges not covered by them.
+        None if there are no rollups covering the range or no values within it.
+        """
+        ranges = [(start_time.posix_ns, end_time.posix_ns)]
+        parts = []
+        for rollup in reversed(self._rollups.get(metric, ())):
+            if rollup.bins is None:
+                continue
+            remaining = []
+            for begin_ns, end_ns in ranges:
+                first_ns, last_ns = rollup.covered(begin_ns, end_ns)
+                if first_ns == last_ns:
+                    remaining.append((begin_ns, end_ns))
+                    continue
+                bins = rollup.slice(first_ns, last_ns)
+                group_ids = np.zeros(len(bins.timestamp), dtype=np.int64)
+                parts.append(_reduce(bins, group_ids, None))
+                remaining.extend(
+                    (begin, end)
+                    for begin, end in ((begin_ns, first_ns), (last_ns, end_ns))
+                    if begin < end
+                )
+            ranges = remaining
+        if not parts:
+            return None
+
+        edges = await asyncio.gather(
+            *[
+                self._client.history_aggregate(
+                    metric, Timestamp(begin_ns), Timestamp(end_ns), timeout=timeout
+                )
+                for begin_ns, end_ns in ranges
+            ]
+        )
+        parts.extend(
+            Aggregates(
+                timestamp=None,
+                minimum=np.array([edge.minimum]),
+                maximum=np.array([edge.maximum]),
+                sum=np.array([edge.sum]),
+                count=np.array([edge.count]),
+                integral_ns=np.array([edge.integral_ns]),
+                active_time=np.array([edge.active_time.ns]),
+            )
+            for edge in edges
+        )
+        columns = Aggregates(
+            None, *(np.concatenate(column) for column in list(zip(*parts))[1:])
+        )
+        has_values = columns.count > 0
+        if not np.any(has_values):
+            # Without values, there is no minimum, maximum or mean to tell
+            return None
+        self.hits += 1
+        return TimeAggregate(
+            timestamp=start_time,
+            minimum=float(columns.minimum[has_values].min()),
+            maximum=float(columns.maximum[has_values].max()),
+            sum=float(columns.sum.sum()),
+            count=int(columns.count.sum()),
+            integral_ns=float(columns.integral_ns.sum()),
+            active_time=Timedelta(int(columns.active_time.sum())),
+        )
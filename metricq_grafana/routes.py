@@ -1,14 +1,25 @@
 """Module for route setup"""
 import functools
 
-from .amqp import get_analyze_data, get_history_data, handle_timeline_request
+from .amqp import (
+    get_analyze_data,
+    get_history_data,
+    handle_timeline_request,
+    prepare_history_data,
+)
 from .views import (
     legacy_cntr_status,
     legacy_counter_data,
+    live,
     search,
     metadata,
+    profile,
+    prometheus_metrics,
+    slow_callbacks,
     test_connection,
+    view_with_columnar,
     view_with_duration_measure,
+    view_with_streaming,
 )
 
 
@@ -17,7 +28,10 @@ def setup_routes(app, cors):
     resource = cors.add(app.router.add_resource("/query"))
     cors.add(
         resource.add_route(
-            "POST", functools.partial(view_with_duration_measure, get_history_data)
+            "POST",
+            functools.partial(
+                view_with_streaming, get_history_data, prepare_history_data
+            ),
         )
     )
 
@@ -31,7 +45,7 @@ def setup_routes(app, cors):
     resource = cors.add(app.router.add_resource("/timeline"))
     cors.add(
         resource.add_route(
-            "POST", functools.partial(view_with_duration_measure, handle_timeline_request)
+            "POST", functools.partial(view_with_columnar, handle_timeline_request)
         )
     )
 
@@ -47,5 +61,17 @@ def setup_routes(app, cors):
     resource = cors.add(app.router.add_resource("/legacy/counter_data.php"))
     cors.add(resource.add_route("GET", legacy_counter_data))
 
+    resource = cors.add(app.router.add_resource("/live"))
+    cors.add(resource.add_route("GET", live))
+
+    resource = cors.add(app.router.add_resource("/metrics"))
+    cors.add(resource.add_route("GET", prometheus_metrics))
+
+    if app.get("admin_endpoints", False):
+        # Not protected in any way, so only with --admin-endpoints,
+        # no CORS so that browsers won't share the responses with other origins
+        app.router.add_get("/admin/profile", profile)
+        app.router.add_get("/admin/slow-callbacks", slow_callbacks)
+
     resource = cors.add(app.router.add_resource("/"))
     cors.add(resource.add_route("GET", test_connection))
@@ -0,0 +1,144 @@
+"""Module for scheduling requests to the database"""
+import asyncio
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+
+from metricq import get_logger
+
+from .monitoring import metrics
+from .request_context import PRIORITY_DEFAULT, current_request
+
+logger = get_logger(__name__)
+timer = time.monotonic
+
+
+class RequestScheduler:
+    """Limits the number of concurrent requests to the database.
+
+    Waiting requests are served by priority first. Within the same priority,
+    clients take turns, and so do the HTTP requests of each client.
+    A single wide query therefore cannot starve all other dashboards.
+    """
+
+    def __init__(self, concurrency):
+        self._concurrency = concurrency
+        self._active = 0
+        # priority -> client -> request id -> waiting futures
+        self._queues = {}
+
+        self.queue_depth = 0
+        self.scheduled = 0
+        self.wait_time_total = 0.0
+        self.wait_time_max = 0.0
+
+    @property
+    def active(self):
+        return self._active
+
+    @asynccontextmanager
+    async def slot(self):
+        """Wait for a free slot, to be used as :code:`async with scheduler.slot():`"""
+        context = current_request.get()
+        if context is None:
+            key = (PRIORITY_DEFAULT, None, None)
+            endpoint = ""
+        else:
+            key = (context.priority, context.client, context.id)
+            endpoint = context.endpoint
+
+        begin = timer()
+        await self._acquire(key)
+        wait_time = timer() - begin
+        self.scheduled += 1
+        self.wait_time_total += wait_time
+        self.wait_time_max = max(self.wait_time_max, wait_time)
+        metrics.scheduler_wait.labels(endpoint=endpoint).observe(wait_time)
+        if wait_time > 1:
+            logger.info(
+                "database request waited {} s, {} requests queued",
+                wait_time,
+                self.queue_depth,
+            )
+        try:
+            yield
+        finally:
+            self._release()
+
+    async def _acquire(self, key):
+        if self._active < self._concurrency and self.queue_depth == 0:
+            self._active += 1
+            return
+
+        priority, client, request = key
+        future = asyncio.get_running_loop().create_future()
+        (
+            self._queues.setdefault(priority, OrderedDict())
+            .setdefault(client, OrderedDict())
+            .setdefault(request, deque())
+            .append(future)
+        )
+        self.queue_depth += 1
+        try:
+            await future
+        except BaseException:
+            if future.done() and not future.cancelled():
+                # We were cancelled after being handed a slot, pass it on
+                self._release()
+            else:
+                self._remove(key, future)
+            raise
+
+    def _release(self):
+        future = self._pop_next()
+        if future is None:
+            self._active -= 1
+        else:
+            # The slot is handed over directly, so self._active stays the same
+            future.set_result(None)
+
+    def _pop_next(self):
+        """The next waiter to hand a slot to, skipping the cancelled ones
+
+        A waiter may be cancelled before it had the chance to remove itself
+        from the queue. It is dropped here, and :meth:`_remove` ignores it later.
+        """
+        while self._queues:
+            priority = min(self._queues)
+            clients = self._queues[priority]
+            client, requests = next(iter(clients.items()))
+            request, futures = next(iter(requests.items()))
+            future = futures.popleft()
+            self.queue_depth -= 1
+
+            # Round robin: move the served request and client to the back
+            if futures:
+                requests.move_to_end(request)
+            else:
+                del requests[request]
+            if requests:
+                clients.move_to_end(client)
+            else:
+                del clients[client]
+            if not clients:
+                del self._queues[priority]
+
+            if not future.done():
+                return future
+        return None
+
+    def _remove(self, key, future):
+        priority, client, request = key
+        try:
+            futures = self._queues[priority][client][request]
+            futures.remove(future)
+        except (KeyError, ValueError):
+            # Already dropped by _pop_next
+            return
+        self.queue_depth -= 1
+        if not futures:
+            del self._queues[priority][client][request]
+            if not self._queues[priority][client]:
+                del self._queues[priority][client]
+                if not self._queues[priority]:
+                    del self._queues[priority]
@@ -0,0 +1,123 @@
+"""Module for JSON serialization of responses"""
+import json
+
+import numpy as np
+from aiohttp import web
+
+from .monitoring import current_endpoint, metrics
+from .utils import sanitize_numbers
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class Datapoints:
+    """A series of datapoints, kept as columns until it is serialized.
+
+    Serialized as a list of [value, time] pairs, or [time, value] if time_first.
+    """
+
+    def __init__(self, timestamps_ms: np.ndarray, values: np.ndarray, time_first=False):
+        self.timestamps_ms = timestamps_ms
+        self.values = values
+        self.time_first = time_first
+
+    def __len__(self):
+        return len(self.timestamps_ms)
+
+    def __iter__(self):
+        timestamps_ms = self.timestamps_ms.tolist()
+        values = sanitize_numbers(self.values)
+        if self.time_first:
+            return zip(timestamps_ms, values)
+        return zip(values, timestamps_ms)
+
+    def time_range(self, start_ms, end_ms) -> "Datapoints":
+        """Only datapoints within [start_ms, end_ms]"""
+        selected = (start_ms <= self.timestamps_ms) & (self.timestamps_ms <= end_ms)
+        return Datapoints(
+            self.timestamps_ms[selected], self.values[selected], self.time_first
+        )
+
+    def to_array(self) -> np.ndarray:
+        columns = (self.timestamps_ms, self.values)
+        if not self.time_first:
+            columns = reversed(columns)
+        return np.column_stack(tuple(columns)).astype(np.float64, copy=False)
+
+
+class Serialized:
+    """A JSON value that has already been serialized, e.g. in a worker process"""
+
+    __slots__ = ("body",)
+
+    def __init__(self, body: bytes):
+        self.body = body
+
+
+def dumps_item(dumps, item) -> bytes:
+    if isinstance(item, Serialized):
+        return item.body
+    return dumps(item)
+
+
+def _dumps_list(dumps, items) -> bytes:
+    return b"[" + b",".join(dumps_item(dumps, item) for item in items) + b"]"
+
+
+def _default_orjson(obj):
+    if isinstance(obj, Datapoints):
+        # NaN and Inf in NumPy arrays are serialized as null by orjson
+        return obj.to_array()
+    raise TypeError
+
+
+def _default_stdlib(obj):
+    if isinstance(obj, Datapoints):
+        return list(obj)
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def dumps_orjson(data) -> bytes:
+    return orjson.dumps(
+        data, default=_default_orjson, option=orjson.OPT_SERIALIZE_NUMPY
+    )
+
+
+def dumps_stdlib(data) -> bytes:
+    return json.dumps(data, default=_default_stdlib).encode()
+
+
+def get_serializer(name="auto"):
+    """Return the serializer function with the given name.
+
+    "auto" picks the fastest one available.
+    """
+    if name == "auto":
+        name = "json" if orjson is None else "orjson"
+    if name == "orjson":
+        if orjson is None:
+            raise ValueError("orjson serializer requested, but package not found")
+        return dumps_orjson
+    if name == "json":
+        return dumps_stdlib
+    raise ValueError(f"Unknown JSON serializer '{name}'")
+
+
+def json_response(request, data, headers=None) -> web.Response:
+    dumps = request.app["json_dumps"]
+    with metrics.serialization_duration.labels(endpoint=current_endpoint()).time():
+        if isinstance(data, list) and any(
+            isinstance(item, Serialized) for item in data
+        ):
+            # Serialized items are inserted as they are
+            body = _dumps_list(dumps, data)
+        else:
+            body = dumps(data)
+    return web.Response(body=body, content_type="application/json", headers=headers)
@@ -3,17 +3,29 @@ import time
 from string import Template
 
 from metricq import get_logger
-from metricq.history_client import (
-    HistoryRequestType,
-    HistoryResponse,
-    HistoryResponseType,
-)
+from metricq.history_client import HistoryResponseType
 
 from .functions import AggregateFunction, AvgFunction, RawFunction
-from .utils import sanitize_number
+from .history_data import HistoryData
+from .monitoring import current_endpoint, metrics
+from .request_context import request_timeout
+from .resolution import plan_metric_resolution
+from .serialization import Datapoints, Serialized
 
 logger = get_logger(__name__)
 
+# Seconds to wait for the data of a single target, unless the deadline of the
+# request is earlier, so that one slow metric doesn't hold up the whole request
+TARGET_TIMEOUT = 10
+
+
+def _serialized_response(target, data, time_measurement, metadata, dumps):
+    """Convert and serialize the response of a target in a worker process"""
+    return [
+        dumps(series)
+        for series in target._convert_response(data, time_measurement, metadata)
+    ]
+
 
 class Target:
     """
@@ -27,6 +39,8 @@ class Target:
         functions=None,
         order_time_value=False,
         scaling_factor=1,
+        decimator=None,
+        max_data_points=None,
     ):
         self.metric = metric
         self.name = name if name else "$metric/$function"
@@ -36,23 +50,55 @@ class Target:
 
         self.order_time_value = order_time_value
         self.scaling_factor = scaling_factor
+        # Raw values are downsampled to at most max_data_points
+        self.decimator = decimator
+        self.max_data_points = max_data_points
 
     async def get_metadata(self, app):
-        result = await app["history_client"].get_metrics(
-            selector=[self.metric], metadata=True
-        )
-        return result.get(self.metric, {})
+        metadata = app["metric_catalog"].metadata(self.metric)
+        if metadata is not None:
+            return metadata
+        metadata = await app["metadata_batcher"].get(self.metric)
+        return {} if metadata is None else metadata
 
-    async def get_response(self, app, start_time, end_time, interval):
+    async def get_response(
+        self, app, start_time, end_time, max_points, serialize=False
+    ):
+        """List of series for each function.
+
+        If serialize is set, the series may already be serialized,
+        in which case large responses are handled in the transform pool.
+        """
         try:
             ((data, time_delta_ns), metadata) = await asyncio.gather(
-                self._get_data(app, start_time, end_time, interval), self._get_metadata(app)
+                self._get_data(app, start_time, end_time, max_points),
+                self._get_metadata(app),
             )
         except asyncio.TimeoutError:
             return []
 
+        return await self.convert_response(
+            app, data, time_delta_ns, metadata, serialize
+        )
+
+    async def convert_response(
+        self, app, data, time_delta_ns, metadata, serialize=False
+    ):
+        """Like :meth:`get_response` with data that has already been requested"""
         if data is None or time_delta_ns is None:
             return []
+        pool = app.get("transform_pool")
+        if serialize and pool is not None and pool.offloads(len(data)):
+            with metrics.offload_duration.labels(endpoint=current_endpoint()).time():
+                bodies = await pool.run(
+                    _serialized_response,
+                    self,
+                    data,
+                    time_delta_ns,
+                    metadata,
+                    app["json_dumps"],
+                )
+            return [Serialized(body) for body in bodies]
         return self._convert_response(data, time_delta_ns, metadata)
 
     @property
@@ -70,19 +116,34 @@ class Target:
 
         return await self.get_metadata(app)
 
-    async def _get_data(self, app, start_time, end_time, interval):
+    async def _get_data(self, app, start_time, end_time, max_points):
         perf_begin_ns = time.perf_counter_ns()
+        resolution = plan_metric_resolution(
+            app["metric_catalog"], self.metric, start_time, end_time, max_points
+        )
         extension = self._additional_interval / 2
         start_time -= extension
         end_time += extension
-        data = await app["history_client"].history_data_request(
-            self.metric,
-            start_time,
-            end_time,
-            interval,
-            timeout=10,
-            request_type=HistoryRequestType.FLEX_TIMELINE,
-        )
+        timeout = request_timeout(TARGET_TIMEOUT)
+        data = None
+        if "rollups" in app:
+            data = await app["rollups"].history_data_request(
+                self.metric,
+                start_time,
+                end_time,
+                resolution.interval,
+                request_type=resolution.request_type,
+                timeout=timeout,
+            )
+        if data is None:
+            data = await app["history_cache"].history_data_request(
+                self.metric,
+                start_time,
+                end_time,
+                resolution.interval,
+                request_type=resolution.request_type,
+                timeout=timeout,
+            )
         perf_end_ns = time.perf_counter_ns()
         return data, (perf_end_ns - perf_begin_ns) / 1e9
 
@@ -92,9 +153,8 @@ class Target:
 
         return Template(self.name).safe_substitute(**metadata)
 
-    def _convert_response(self, response: HistoryResponse, time_measurement, metadata):
-        # TODO find a way to cache the response.aggregates again...
-        if response.mode == HistoryResponseType.VALUES:
+    def _convert_response(self, data: HistoryData, time_measurement, metadata):
+        if data.mode == HistoryResponseType.VALUES:
             # Drop all aggregates and add raw values
             has_aggregate = any(
                 [isinstance(f, AggregateFunction) for f in self.functions]
@@ -104,28 +164,36 @@ class Target:
                     f for f in self.functions if not isinstance(f, AggregateFunction)
                 ] + [RawFunction()]
 
+        # All functions share the same data, which is decoded only once
         return [
             {
                 "target": self._get_aliased_target(function, metadata),
                 "time_measurements": {
-                    "db": response.request_duration,
+                    "db": data.request_duration,
                     "http": time_measurement,
                 },
-                "datapoints": [
-                    data for data in self._transform_data(function, response)
-                ],
+                "datapoints": self._transform_data(function, data),
             }
             for function in self.functions
         ]
 
-    def _transform_data(self, function, response):
-        for timestamp, value in function.transform_data(response):
-            if value is not None:
-                value = value * self.scaling_factor
-            if self.order_time_value:
-                yield timestamp.posix_ms, sanitize_number(value)
-            else:
-                yield sanitize_number(value), timestamp.posix_ms
+    def _transform_data(self, function, data):
+        with metrics.transform_duration.labels(
+            endpoint=current_endpoint(), function=str(function)
+        ).time():
+            timestamps, values = function.transform_data(data)
+            if (
+                isinstance(function, RawFunction)
+                and self.decimator is not None
+                and self.max_data_points is not None
+            ):
+                selected = self.decimator(timestamps, values, self.max_data_points)
+                timestamps, values = timestamps[selected], values[selected]
+            return Datapoints(
+                timestamps / 1e6,
+                values * self.scaling_factor,
+                time_first=self.order_time_value,
+            )
 
     @property
     def _additional_interval(self):
@@ -134,3 +202,67 @@ class Target:
     @staticmethod
     def _pattern_keys(pattern):
         return [s[1] or s[2] for s in Template.pattern.findall(pattern) if s[1] or s[2]]
+
+
+class TargetGroup:
+    """Targets of the same metric within one request, e.g. from several panels
+    or overlapping patterns.
+
+    The data is requested only once, for the range of the target with the
+    largest moving average window, and shared by all targets.
+    """
+
+    def __init__(self, targets):
+        self.targets = targets
+        self.metric = targets[0].metric
+        assert all(target.metric == self.metric for target in targets)
+
+    async def get_response(
+        self, app, start_time, end_time, max_points, serialize=False
+    ):
+        """Series of all targets, in their order"""
+        responses = await self.get_responses(
+            app, start_time, end_time, max_points, serialize
+        )
+        return [series for response in responses for series in response]
+
+    async def get_responses(
+        self, app, start_time, end_time, max_points, serialize=False
+    ):
+        """The list of series of each target, in their order"""
+        if len(self.targets) == 1:
+            return [
+                await self.targets[0].get_response(
+                    app, start_time, end_time, max_points, serialize
+                )
+            ]
+
+        widest = max(self.targets, key=lambda target: target._additional_interval)
+        try:
+            (data, time_delta_ns), metadata = await asyncio.gather(
+                widest._get_data(app, start_time, end_time, max_points),
+                self._get_metadata(app),
+            )
+        except asyncio.TimeoutError:
+            return [[] for _ in self.targets]
+
+        responses = []
+        for target in self.targets:
+            target_data = data
+            extension = target._additional_interval / 2
+            if data is not None and extension < widest._additional_interval / 2:
+                # Only the range this target would have requested on its own
+                target_data = data.trim(
+                    (start_time - extension).posix_ns, (end_time + extension).posix_ns
+                )
+            responses.append(
+                await target.convert_response(
+                    app, target_data, time_delta_ns, dict(metadata), serialize
+                )
+            )
+        return responses
+
+    async def _get_metadata(self, app):
+        if not any(target.metadata_required for target in self.targets):
+            return {}
+        return await self.targets[0].get_metadata(app)
@@ -1,16 +1,20 @@
-import math
+import numpy as np
 
 
-def sanitize_number(value):
-    """Convert NaN and Inf to None - because JSON is dumb"""
-    if value is not None and math.isfinite(value):
-        return value
-    return None
+def sanitize_numbers(values):
+    """Convert an array to a list with NaN and Inf as None - because JSON is dumb"""
+    result = values.tolist()
+    for index in np.flatnonzero(~np.isfinite(values)).tolist():
+        result[index] = None
+    return result
 
 
 async def unpack_metric(app, metric):
-    # guess if this is a pattern (regex) to expand by sending it to the manager
+    # guess if this is a pattern (regex) to expand with the catalog or the manager
     if "(" in metric and ")" in metric:
+        metrics = app["metric_catalog"].match(metric)
+        if metrics is not None:
+            return metrics
         metrics = await app["history_client"].get_metrics(
             metadata=False, historic=True, selector=metric
         )
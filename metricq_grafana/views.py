@@ -1,11 +1,14 @@
 """Module for view functions"""
+import asyncio
+import json
 import logging
 import time
 from asyncio import TimeoutError
 from json import JSONDecodeError
 
-from aiohttp import web
+from aiohttp import WSMsgType, web
 from metricq import get_logger
+from metricq.types import Timedelta
 
 from .amqp import (
     get_counter_data,
@@ -13,13 +16,34 @@ from .amqp import (
     get_metadata,
     get_metric_list,
 )
+from .columnar import accepts_columnar, columnar_response
+from .live import LiveSubscription
+from .monitoring import collect_app_stats, current_endpoint, metrics
+from .request_context import current_request
+from .serialization import dumps_item, json_response
+from .utils import unpack_metric
 
 logger = get_logger(__name__)
 
 
-async def view_with_duration_measure(amqp_function, request):
+def _timeout_error() -> web.HTTPException:
+    """The error for a timed out request to the database"""
+    context = current_request.get()
+    if context is not None and context.expired:
+        return web.HTTPGatewayTimeout()
+    # No one responds means not found
+    return web.HTTPNotFound()
+
+
+async def view_with_duration_measure(amqp_function, request, columnar=False):
+    """Call amqp_function with the request data and respond with its result.
+
+    If columnar is set, amqp_function is asked for columns and the response
+    uses the columnar format.
+    """
     try:
-        req_json = await request.json()
+        with metrics.parse_duration.labels(endpoint=current_endpoint()).time():
+            req_json = await request.json()
     except JSONDecodeError:
         raise web.HTTPBadRequest()
 
@@ -28,7 +52,10 @@ async def view_with_duration_measure(amqp_function, request):
     try:
         perf_begin_ns = time.perf_counter_ns()
         perf_begin_process_ns = time.process_time_ns()
-        resp = await amqp_function(request.app, req_json)
+        if columnar:
+            resp = await amqp_function(request.app, req_json, columnar=True)
+        else:
+            resp = await amqp_function(request.app, req_json)
         perf_end_ns = time.perf_counter_ns()
         perf_end_process_ns = time.process_time_ns()
         perf_diff = (perf_end_ns - perf_begin_ns) / 1e9
@@ -55,13 +82,98 @@ async def view_with_duration_measure(amqp_function, request):
             perf_diff,
         )
     except TimeoutError:
-        # No one responds means not found
-        raise web.HTTPNotFound()
+        raise _timeout_error()
     except ValueError:
         raise web.HTTPBadRequest()
     except KeyError:
         raise web.HTTPBadRequest()
-    return web.json_response(resp, headers=headers)
+    if columnar:
+        return columnar_response(request, resp, headers=headers)
+    return json_response(request, resp, headers=headers)
+
+
+async def view_with_columnar(amqp_function, request):
+    """Like view_with_duration_measure, in the columnar format if the client
+    accepts it, e.g. with "Accept: application/vnd.metricq.columnar".
+    """
+    return await view_with_duration_measure(
+        amqp_function, request, columnar=accepts_columnar(request)
+    )
+
+
+async def _series_or_error(metric, awaitable):
+    """The series of a streamed metric, or an entry with the error.
+
+    Once streaming has started, the status can't tell about an error anymore.
+    """
+    try:
+        return await awaitable
+    except Exception as e:
+        logger.error("failed to stream {}: {}", metric, e)
+        return [{"target": metric, "datapoints": [], "error": str(e)}]
+
+
+async def view_with_streaming(amqp_function, prepare_function, request):
+    """Like view_with_duration_measure, unless requested with ?stream=true.
+
+    Then each result is written to a chunked response as soon as it is complete,
+    instead of waiting for all of them. The order of the results is not preserved.
+    A metric that fails is reported with an entry with its "error", e.g.
+    {"target": "foo.bar", "datapoints": [], "error": "..."}.
+    """
+    if request.query.get("stream", "false").lower() not in ["1", "true"]:
+        return await view_with_duration_measure(amqp_function, request)
+
+    try:
+        with metrics.parse_duration.labels(endpoint=current_endpoint()).time():
+            req_json = await request.json()
+    except JSONDecodeError:
+        raise web.HTTPBadRequest()
+
+    logger.debug("{} request data: {}", prepare_function.__name__, req_json)
+
+    perf_begin_ns = time.perf_counter_ns()
+    try:
+        pending = await prepare_function(request.app, req_json)
+    except TimeoutError:
+        raise _timeout_error()
+    except (ValueError, KeyError):
+        raise web.HTTPBadRequest()
+
+    dumps = request.app["json_dumps"]
+    response = web.StreamResponse(headers={"Content-Type": "application/json"})
+    response.enable_chunked_encoding()
+    await response.prepare(request)
+
+    serialization = metrics.serialization_duration.labels(endpoint=current_endpoint())
+    tasks = [
+        asyncio.ensure_future(_series_or_error(metric, awaitable))
+        for metric, awaitable in pending.items()
+    ]
+    try:
+        separator = b"["
+        for result in asyncio.as_completed(tasks):
+            for series in await result:
+                with serialization.time():
+                    chunk = dumps_item(dumps, series)
+                await response.write(separator + chunk)
+                separator = b","
+        await response.write(b"[]" if separator == b"[" else b"]")
+        await response.write_eof()
+    finally:
+        # e.g. if the client went away
+        for task in tasks:
+            task.cancel()
+
+    perf_diff = (time.perf_counter_ns() - perf_begin_ns) / 1e9
+    logger.log(
+        logging.DEBUG if perf_diff < 1 else logging.INFO,
+        "{} for {} results took {} s (streaming)",
+        prepare_function.__name__,
+        len(tasks),
+        perf_diff,
+    )
+    return response
 
 
 async def search(request: web.Request):
@@ -73,7 +185,7 @@ async def search(request: web.Request):
     metric_list = await get_metric_list(
         request.app, search_query, metadata=metadata_requested, limit=limit
     )
-    return web.json_response(metric_list)
+    return json_response(request, metric_list)
 
 
 async def metadata(request):
@@ -81,7 +193,7 @@ async def metadata(request):
     logger.debug("Metadata query: {}", metric)
 
     try:
-        return web.json_response(await get_metadata(request.app, metric))
+        return json_response(request, await get_metadata(request.app, metric))
     except KeyError as e:
         raise web.HTTPNotFound() from e
 
@@ -105,7 +217,104 @@ async def legacy_counter_data(request):
         int(data["stop"]),
         int(data["width"]),
     )
-    return web.json_response(counter_data)
+    return json_response(request, counter_data)
+
+
+async def live(request):
+    """Push live data over a WebSocket.
+
+    The client subscribes by sending {"metrics": [...], "intervalMs": 1000},
+    which replaces any previous subscription.
+    For each completed interval, the server sends
+    {metric: [[time in ms, mean, minimum, maximum, count], ...]}.
+    """
+    live_sink = request.app.get("live_sink")
+    if live_sink is None:
+        raise web.HTTPNotFound()
+
+    ws = web.WebSocketResponse(heartbeat=30)
+    await ws.prepare(request)
+
+    subscription = LiveSubscription(Timedelta.from_s(1).ns)
+    sender = asyncio.ensure_future(
+        _send_live_data(ws, subscription, request.app["json_dumps"])
+    )
+    try:
+        async for message in ws:
+            if message.type != WSMsgType.TEXT:
+                continue
+            try:
+                req_json = json.loads(message.data)
+                if len(req_json["metrics"]) > live_sink.max_metrics_per_client:
+                    raise ValueError(
+                        f"at most {live_sink.max_metrics_per_client} metrics"
+                    )
+                metric_list = []
+                for metric in req_json["metrics"]:
+                    metric_list.extend(await unpack_metric(request.app, metric))
+                interval = Timedelta.from_ms(req_json.get("intervalMs", 1000))
+                if interval.ns <= 0:
+                    raise ValueError("intervalMs must be positive")
+                await live_sink.update(subscription, metric_list)
+            except (ValueError, KeyError, TypeError) as e:
+                await ws.send_json({"error": f"invalid subscription: {e}"})
+                continue
+
+            logger.debug("live subscription to {} metrics", len(metric_list))
+            subscription.set_interval(interval.ns)
+    finally:
+        sender.cancel()
+        await live_sink.remove(subscription)
+    return ws
+
+
+async def _send_live_data(ws, subscription, dumps):
+    while not ws.closed:
+        await subscription.wait(subscription.interval_ns / 1e9)
+        subscription.complete_overdue()
+        frames = subscription.take()
+        if frames:
+            try:
+                # While this waits for a slow client, new data is merged
+                await ws.send_str(dumps(frames).decode())
+            except ConnectionResetError:
+                return
+
+
+async def prometheus_metrics(request):
+    lines = [*metrics.render(), *collect_app_stats(request.app)]
+    return web.Response(
+        text="\n".join(lines) + "\n",
+        content_type="text/plain",
+        headers={"X-Content-Type-Options": "nosniff"},
+    )
+
+
+async def profile(request):
+    """Sample the event loop for ?seconds=N and return the folded stacks"""
+    try:
+        duration = float(request.query.get("seconds", "10"))
+    except ValueError:
+        raise web.HTTPBadRequest()
+    if not 0 < duration <= request.app["profiler"].MAX_DURATION:
+        raise web.HTTPBadRequest()
+    try:
+        folded = await request.app["profiler"].profile(duration)
+    except RuntimeError:
+        raise web.HTTPConflict()
+    return web.Response(
+        text=folded,
+        content_type="text/plain",
+        headers={"Content-Disposition": 'attachment; filename="profile.folded"'},
+    )
+
+
+async def slow_callbacks(request):
+    # Not recorded with --slow-callback-threshold 0
+    recorder = request.app.get("slow_callbacks")
+    if recorder is None:
+        raise web.HTTPNotFound()
+    return json_response(request, list(recorder.records))
 
 
 async def test_connection(request):
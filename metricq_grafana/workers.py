@@ -0,0 +1,53 @@
+"""Module for running the server in multiple worker processes"""
+import multiprocessing
+import multiprocessing.connection
+import signal
+
+from metricq import get_logger
+
+logger = get_logger(__name__)
+
+
+def run_workers(count, serve):
+    """Fork count processes running serve(index) and wait until one of them exits.
+
+    The workers share the listening port via SO_REUSEPORT, so serve has to bind
+    with reuse_port=True.
+    Each worker shuts down on its own, e.g. its watchdog stops it if its connection
+    to MetricQ is lost. Then all others are stopped as well, so that whoever
+    supervises this process can restart the service as a whole.
+    """
+    context = multiprocessing.get_context("fork")
+    workers = [
+        context.Process(target=serve, args=(index,), name=f"worker-{index}")
+        for index in range(count)
+    ]
+
+    def terminate(signum=None, frame=None):
+        for worker in workers:
+            if worker.is_alive():
+                # Handled by aiohttp like Ctrl+C, including cleanup of the app
+                worker.terminate()
+
+    for worker in workers:
+        worker.start()
+    logger.info("started {} workers", count)
+
+    # Only after forking, the workers keep the default handlers
+    previous_handlers = {
+        signum: signal.signal(signum, terminate)
+        for signum in (signal.SIGINT, signal.SIGTERM)
+    }
+    try:
+        sentinels = {worker.sentinel: worker for worker in workers}
+        exited = sentinels[multiprocessing.connection.wait(list(sentinels))[0]]
+        logger.info(
+            "{} exited with {}, stopping all workers", exited.name, exited.exitcode
+        )
+        terminate()
+        for worker in workers:
+            worker.join()
+    finally:
+        for signum, handler in previous_handlers.items():
+            signal.signal(signum, handler)
+    return exited.exitcode
@@ -13,7 +13,7 @@ setup(
       """,
     install_requires=[
         "aio-pika",
-        "aiohttp ~= 3.8",
+        "aiohttp ~= 3.9",
         "aiohttp-cors",
         "click",
         "click-completion",
@@ -21,8 +21,15 @@ setup(
         "colorama",
         "metricq ~= 4.1.0",
         "aiocache",
+        "numpy",
     ],
-    extras_require={"journallogger": ["systemd"]},
+    extras_require={
+        "journallogger": ["systemd"],
+        "orjson": ["orjson"],
+        "brotli": ["brotli"],
+        "zstd": ["zstandard"],
+        "test": ["pytest"],
+    },
     setup_requires=["setuptools_scm"],
     use_scm_version=True,
 )
@@ -0,0 +1,130 @@
+"""Tests for the tile-aligned history cache"""
+import asyncio
+
+import numpy as np
+import pytest
+from metricq.history_client import HistoryResponse, HistoryResponseType
+from metricq.history_pb2 import HistoryResponse as HistoryResponseProto
+from metricq.types import Timedelta, Timestamp
+
+from metricq_grafana.cache import MAX_TILES, TILE_INTERVALS, HistoryCache
+
+INTERVAL = Timedelta.from_s(1)
+TILE_NS = INTERVAL.ns * TILE_INTERVALS
+# Long settled, so that no tile is hot
+BEGIN_NS = 1_500_000_000 * 10**9 // TILE_NS * TILE_NS
+
+
+class _Database:
+    """An aggregate every INTERVAL, with its index as value.
+
+    Like the database, the response includes one entry before the start and
+    one after the end of the range.
+    """
+
+    def __init__(self):
+        self.requests = []
+
+    async def history_data_request(
+        self, metric, start_time, end_time, interval, timeout, request_type
+    ):
+        self.requests.append((start_time.posix_ns, end_time.posix_ns))
+        await asyncio.sleep(0)
+        first = start_time.posix_ns // INTERVAL.ns
+        last = -(-end_time.posix_ns // INTERVAL.ns)
+        proto = HistoryResponseProto()
+        previous = 0
+        for index in range(first, last + 1):
+            proto.time_delta.append(index * INTERVAL.ns - previous)
+            previous = index * INTERVAL.ns
+            aggregate = proto.aggregate.add()
+            aggregate.minimum = aggregate.maximum = aggregate.sum = float(index)
+            aggregate.count = 1
+            aggregate.active_time = INTERVAL.ns
+            aggregate.integral = float(index) * INTERVAL.ns
+        return HistoryResponse(proto, request_duration=0.0)
+
+
+def _request(cache, start_ns, end_ns):
+    return asyncio.run(
+        cache.history_data_request(
+            "foo.bar", Timestamp(start_ns), Timestamp(end_ns), INTERVAL
+        )
+    )
+
+
+def _expected_indexes(start_ns, end_ns):
+    """What the database returns for the range"""
+    return np.arange(start_ns // INTERVAL.ns, -(-end_ns // INTERVAL.ns) + 1)
+
+
+@pytest.mark.parametrize(
+    "start_ns, end_ns",
+    [
+        # Within one tile
+        (BEGIN_NS + 10 * INTERVAL.ns, BEGIN_NS + 20 * INTERVAL.ns),
+        # Not aligned to intervals, across several tiles
+        (BEGIN_NS + 100 * INTERVAL.ns + 123, BEGIN_NS + 3 * TILE_NS + 456),
+        # Exactly at tile boundaries
+        (BEGIN_NS, BEGIN_NS + 2 * TILE_NS),
+        (BEGIN_NS + TILE_NS - 1, BEGIN_NS + TILE_NS + 1),
+    ],
+)
+def test_stitched_like_database(start_ns, end_ns):
+    database = _Database()
+    data = _request(HistoryCache(database), start_ns, end_ns)
+
+    assert data.mode is HistoryResponseType.AGGREGATES
+    aggregates = data.aggregates()
+    expected = _expected_indexes(start_ns, end_ns)
+    np.testing.assert_array_equal(aggregates.timestamp, expected * INTERVAL.ns)
+    np.testing.assert_array_equal(aggregates.minimum, expected)
+    # Whole tiles are requested
+    for request_start_ns, request_end_ns in database.requests:
+        assert request_start_ns % TILE_NS == 0
+        assert request_end_ns - request_start_ns == TILE_NS
+
+
+def test_only_missing_tiles_are_requested():
+    database = _Database()
+    cache = HistoryCache(database)
+    _request(cache, BEGIN_NS, BEGIN_NS + 2 * TILE_NS - 1)
+    assert len(database.requests) == 2
+
+    data = _request(cache, BEGIN_NS + TILE_NS + 5, BEGIN_NS + 3 * TILE_NS + 5)
+    assert len(database.requests) == 4
+    assert database.requests[2:] == [
+        (BEGIN_NS + 2 * TILE_NS, BEGIN_NS + 3 * TILE_NS),
+        (BEGIN_NS + 3 * TILE_NS, BEGIN_NS + 4 * TILE_NS),
+    ]
+    assert cache.hits == 1
+    np.testing.assert_array_equal(
+        data.aggregates().minimum,
+        _expected_indexes(BEGIN_NS + TILE_NS + 5, BEGIN_NS + 3 * TILE_NS + 5),
+    )
+
+    _request(cache, BEGIN_NS, BEGIN_NS + 4 * TILE_NS - 1)
+    assert len(database.requests) == 4
+
+
+def test_wide_requests_bypass_cache():
+    database = _Database()
+    start_ns, end_ns = BEGIN_NS, BEGIN_NS + MAX_TILES * TILE_NS
+    data = _request(HistoryCache(database), start_ns, end_ns)
+    assert database.requests == [(start_ns, end_ns)]
+    assert len(data) == len(_expected_indexes(start_ns, end_ns))
+
+
+def test_least_recently_used_tiles_are_evicted():
+    database = _Database()
+    # Room for about two tiles
+    cache = HistoryCache(database, max_points=2 * (TILE_INTERVALS + 1))
+    for tile in (0, 1, 0, 2):
+        _request(cache, BEGIN_NS + tile * TILE_NS, BEGIN_NS + tile * TILE_NS + 1)
+    assert len(database.requests) == 3
+
+    # Tile 1 was evicted, tile 0 was used more recently
+    _request(cache, BEGIN_NS, BEGIN_NS + 1)
+    assert len(database.requests) == 3
+    _request(cache, BEGIN_NS + TILE_NS, BEGIN_NS + TILE_NS + 1)
+    assert len(database.requests) == 4
@@ -0,0 +1,130 @@
+"""Tests for the in-memory catalog of historic metrics"""
+import asyncio
+
+import pytest
+
+from metricq_grafana.amqp import get_metric_list
+from metricq_grafana.catalog import MetricCatalog
+
+METADATA = {
+    "elab.ariel.power": {"unit": "W"},
+    "elab.ariel.s0.dram.power": {"unit": "W"},
+    "elab.ariel.s0.package.power": {"unit": "W"},
+    "elab.ariel.s0.package.temperature": {"unit": "°C"},
+    "taurus.taurusi1001.power": {"unit": "W"},
+    "taurus.taurusi1002.cpu0.temp": {"unit": "°C"},
+    "ab": {},
+}
+
+
+class _ManagerClient:
+    """Answers get_metrics like the manager, counting the requests"""
+
+    def __init__(self):
+        self.requests = []
+
+    async def get_metrics(self, **kwargs):
+        self.requests.append(kwargs)
+        return ["from.manager"]
+
+
+@pytest.fixture
+def catalog():
+    catalog = MetricCatalog(_ManagerClient())
+    catalog.update(METADATA)
+    return catalog
+
+
+def test_not_loaded():
+    catalog = MetricCatalog(_ManagerClient())
+    assert not catalog.loaded
+    assert catalog.infix("power") is None
+    assert catalog.prefix("elab") is None
+    assert catalog.match("power") is None
+    assert catalog.metadata("elab.ariel.power") is None
+
+
+@pytest.mark.parametrize(
+    "infix",
+    ["power", "package", "s0.p", "taurusi100", "i1002.c", "ar", "a", "", "x.y.z"],
+)
+def test_infix(catalog, infix):
+    assert catalog.infix(infix) == sorted(name for name in METADATA if infix in name)
+
+
+def test_infix_needs_consecutive_trigrams(catalog):
+    # All trigrams occur in elab.ariel.s0.package.power, but not consecutively
+    assert catalog.infix("s0.power") == []
+
+
+def test_infix_limit(catalog):
+    assert catalog.infix("power", limit=2) == [
+        "elab.ariel.power",
+        "elab.ariel.s0.dram.power",
+    ]
+
+
+def test_prefix(catalog):
+    assert catalog.prefix("elab.ariel.s0.") == [
+        "elab.ariel.s0.dram.power",
+        "elab.ariel.s0.package.power",
+        "elab.ariel.s0.package.temperature",
+    ]
+    assert catalog.prefix("elab", limit=1) == ["elab.ariel.power"]
+    assert catalog.prefix("nothing") == []
+
+
+def test_match(catalog):
+    assert catalog.match(r"s0\..*power$") == [
+        "elab.ariel.s0.dram.power",
+        "elab.ariel.s0.package.power",
+    ]
+    assert catalog.match("^taurus", limit=1) == ["taurus.taurusi1001.power"]
+    # Python can't compile it, the manager may still know it
+    assert catalog.match("(") is None
+
+
+def test_update_replaces_matches(catalog):
+    assert catalog.match("power$") == [
+        name for name in sorted(METADATA) if name.endswith("power")
+    ]
+    catalog.update({"new.power": {}})
+    assert catalog.match("power$") == ["new.power"]
+    assert catalog.infix("power") == ["new.power"]
+
+
+def test_metadata_is_a_copy(catalog):
+    metadata = catalog.metadata("elab.ariel.power")
+    assert metadata == {"unit": "W"}
+    metadata["unit"] = "kW"
+    assert catalog.metadata("elab.ariel.power") == {"unit": "W"}
+    assert catalog.metadata("unknown") is None
+
+
+def _search(catalog, query, **kwargs):
+    app = {"metric_catalog": catalog, "history_client": catalog._client}
+    return asyncio.run(get_metric_list(app, query, **kwargs))
+
+
+def test_search(catalog):
+    assert _search(catalog, "package") == [
+        "elab.ariel.s0.package.power",
+        "elab.ariel.s0.package.temperature",
+    ]
+    assert _search(catalog, "/.*temp.*/") == [
+        "elab.ariel.s0.package.temperature",
+        "taurus.taurusi1002.cpu0.temp",
+    ]
+    assert _search(catalog, "cpu0", metadata=True) == {
+        "taurus.taurusi1002.cpu0.temp": {"unit": "°C"}
+    }
+    assert _search(catalog, "power", limit=1) == ["elab.ariel.power"]
+    assert catalog._client.requests == []
+
+
+def test_search_falls_back_to_manager():
+    catalog = MetricCatalog(_ManagerClient())
+    assert _search(catalog, "power") == ["from.manager"]
+    assert catalog._client.requests == [
+        {"metadata": False, "historic": True, "infix": "power", "limit": 100}
+    ]
@@ -0,0 +1,109 @@
+"""Tests for the binary columnar format of /timeline responses"""
+import json
+import struct
+
+import numpy as np
+from aiohttp.test_utils import make_mocked_request
+
+from metricq_grafana.columnar import (
+    CONTENT_TYPE,
+    FORMAT_VERSION,
+    MAGIC,
+    accepts_columnar,
+    encode,
+)
+from metricq_grafana.history_data import Aggregates, Values
+
+
+def _decode(body):
+    """Decode as a client would, following the description in the module"""
+    magic, version, header_length = struct.unpack_from("<4sII", body)
+    assert magic == MAGIC
+    assert version == FORMAT_VERSION
+    header_begin = struct.calcsize("<4sII")
+    header = json.loads(body[header_begin : header_begin + header_length])
+    data_begin = -(-(header_begin + header_length) // 8) * 8
+
+    results = {}
+    for metric, result in header.items():
+        if "columns" not in result:
+            results[metric] = result
+            continue
+        result = dict(result)
+        length = result.pop("length")
+        columns = {}
+        for name, description in result.pop("columns").items():
+            offset = data_begin + description["offset"]
+            assert offset % 8 == 0
+            columns[name] = np.frombuffer(
+                body, dtype=np.dtype(description["dtype"]), count=length, offset=offset
+            )
+        result[result["mode"]] = columns
+        results[metric] = result
+    return results
+
+
+def test_round_trip():
+    rng = np.random.default_rng(0)
+    aggregates = Aggregates(
+        timestamp=np.arange(5, dtype=np.int64) * 10**9,
+        minimum=rng.normal(size=5),
+        maximum=rng.normal(size=5),
+        sum=rng.normal(size=5),
+        count=np.arange(5, dtype=np.uint64),
+        integral_ns=rng.normal(size=5),
+        active_time=np.full(5, 10**9, dtype=np.int64),
+    )
+    # Odd lengths and byte order, which must be aligned and converted
+    values = Values(
+        timestamp=np.arange(3, dtype=">i8"),
+        value=np.array([1.5, np.nan, -2.0], dtype=">f8"),
+    )
+    time_measurements = {"db": 0.1, "http": 0.2}
+    results = {
+        "foo.aggregates": {
+            "mode": "aggregates",
+            "time_measurements": time_measurements,
+            "aggregates": aggregates,
+        },
+        "foo.values": {
+            "mode": "values",
+            "time_measurements": time_measurements,
+            "values": values,
+        },
+        "foo.empty": {"mode": "empty", "time_measurements": time_measurements},
+        "foo.missing": {"error": "Missing response. Metric probably does not exist."},
+    }
+
+    decoded = _decode(encode(results))
+
+    assert decoded.keys() == results.keys()
+    for metric in ["foo.empty", "foo.missing"]:
+        assert decoded[metric] == results[metric]
+    for metric, mode, columns in [
+        ("foo.aggregates", "aggregates", aggregates),
+        ("foo.values", "values", values),
+    ]:
+        assert decoded[metric]["mode"] == mode
+        assert decoded[metric]["time_measurements"] == time_measurements
+        assert list(decoded[metric][mode]) == list(columns._fields)
+        for name, column in zip(columns._fields, columns):
+            np.testing.assert_array_equal(decoded[metric][mode][name], column)
+
+
+def test_empty_columns():
+    values = Values(np.empty(0, dtype=np.int64), np.empty(0))
+    decoded = _decode(encode({"foo": {"mode": "values", "values": values}}))
+    assert len(decoded["foo"]["values"]["timestamp"]) == 0
+    assert len(decoded["foo"]["values"]["value"]) == 0
+
+
+def test_accepts_columnar():
+    def accepts(accept):
+        headers = {} if accept is None else {"Accept": accept}
+        return accepts_columnar(make_mocked_request("POST", "/", headers=headers))
+
+    assert accepts(CONTENT_TYPE)
+    assert accepts(f"application/json;q=0.5, {CONTENT_TYPE};q=0.9")
+    assert not accepts("application/json")
+    assert not accepts(None)
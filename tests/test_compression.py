@@ -0,0 +1,68 @@
+"""Tests for the negotiation and compression of responses"""
+import asyncio
+import gzip
+
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+
+from metricq_grafana.compression import _gzip, compression_middleware, negotiate
+
+MIN_SIZE = 1024
+
+
+def test_gzip_round_trip():
+    data = b"metricq" * 1000
+    assert gzip.decompress(_gzip(data)) == data
+
+
+def test_negotiate():
+    assert negotiate("gzip") == "gzip"
+    assert negotiate("gzip, deflate") == "gzip"
+    assert negotiate("deflate;q=1.0, gzip;q=0.5") == "gzip"
+    assert negotiate("*") is not None
+    assert negotiate("gzip;q=0") is None
+    assert negotiate("*;q=0") is None
+    assert negotiate("identity") is None
+    assert negotiate("") is None
+
+
+async def _get(body, accept_encoding):
+    async def handler(request):
+        return web.Response(body=body)
+
+    app = web.Application(middlewares=[compression_middleware])
+    app["compression_min_size"] = MIN_SIZE
+    app.router.add_get("/", handler)
+
+    # The client sends its own Accept-Encoding otherwise
+    if accept_encoding is None:
+        options = {"skip_auto_headers": ["Accept-Encoding"]}
+    else:
+        options = {"headers": {"Accept-Encoding": accept_encoding}}
+    async with TestClient(TestServer(app), auto_decompress=False) as client:
+        response = await client.get("/", **options)
+        assert response.status == 200
+        return response.headers, await response.read()
+
+
+def test_gzip_response():
+    body = b"x" * MIN_SIZE
+    headers, data = asyncio.run(_get(body, "gzip"))
+    assert headers["Content-Encoding"] == "gzip"
+    assert "Accept-Encoding" in headers["Vary"]
+    assert gzip.decompress(data) == body
+
+
+def test_identity_below_threshold():
+    body = b"x" * (MIN_SIZE - 1)
+    headers, data = asyncio.run(_get(body, "gzip"))
+    assert "Content-Encoding" not in headers
+    assert data == body
+
+
+def test_identity_if_not_accepted():
+    body = b"x" * MIN_SIZE
+    for accept_encoding in [None, "identity", "gzip;q=0"]:
+        headers, data = asyncio.run(_get(body, accept_encoding))
+        assert "Content-Encoding" not in headers
+        assert data == body
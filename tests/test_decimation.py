@@ -0,0 +1,93 @@
+"""Tests for the downsampling of raw values"""
+import numpy as np
+import pytest
+
+from metricq_grafana.decimation import get_decimator, lttb, minmax
+
+
+def _series(seed, count):
+    rng = np.random.default_rng(seed)
+    timestamps = np.cumsum(rng.integers(1, 10**9, size=count))
+    values = rng.normal(0, 1, size=count)
+    return timestamps, values
+
+
+def _check_indices(selected, count, max_points):
+    assert len(selected) <= max(int(max_points), 0)
+    assert np.all(np.diff(selected) > 0)
+    assert np.all((selected >= 0) & (selected < count))
+
+
+@pytest.mark.parametrize("decimator", [lttb, minmax])
+@pytest.mark.parametrize("max_points", [0, 1, 2, 3, 4, 7, 10.5, 100, 999])
+@pytest.mark.parametrize("seed", range(5))
+def test_at_most_max_points(decimator, max_points, seed):
+    timestamps, values = _series(seed, 1000)
+    selected = decimator(timestamps, values, max_points)
+    _check_indices(selected, len(timestamps), max_points)
+
+
+@pytest.mark.parametrize("decimator", [lttb, minmax])
+@pytest.mark.parametrize("count", [0, 1, 5, 100])
+def test_keeps_everything_if_it_fits(decimator, count):
+    timestamps, values = _series(0, count)
+    np.testing.assert_array_equal(decimator(timestamps, values, 100), range(count))
+
+
+@pytest.mark.parametrize("max_points", [2, 3, 10, 100])
+def test_lttb_keeps_endpoints(max_points):
+    timestamps, values = _series(1, 1000)
+    selected = lttb(timestamps, values, max_points)
+    assert len(selected) == max_points
+    assert selected[0] == 0
+    assert selected[-1] == len(timestamps) - 1
+
+
+def test_lttb_single_point():
+    timestamps, values = _series(1, 1000)
+    np.testing.assert_array_equal(lttb(timestamps, values, 1), [0])
+
+
+def test_lttb_keeps_spike():
+    timestamps = np.arange(1000) * 10**9
+    values = np.zeros(1000)
+    values[567] = 100.0
+    assert 567 in lttb(timestamps, values, 20)
+
+
+@pytest.mark.parametrize("max_points", [2, 10, 100])
+def test_minmax_keeps_extremes(max_points):
+    timestamps, values = _series(2, 1000)
+    selected = minmax(timestamps, values, max_points)
+    assert np.argmax(values) in selected
+    assert np.argmin(values) in selected
+
+
+def test_minmax_keeps_extremes_of_each_bucket():
+    # Two buckets of equal time, one per half
+    timestamps = np.arange(100) * 10**9
+    values = np.sin(np.arange(100))
+    selected = minmax(timestamps, values, 4)
+    for half in (slice(0, 50), slice(50, 100)):
+        offset = half.start
+        assert offset + np.argmax(values[half]) in selected
+        assert offset + np.argmin(values[half]) in selected
+
+
+@pytest.mark.parametrize("decimator", [lttb, minmax])
+def test_prefers_values_over_nan(decimator):
+    timestamps = np.arange(100) * 10**9
+    values = np.full(100, np.nan)
+    values[::10] = np.arange(10)
+    selected = decimator(timestamps, values, 10)
+    _check_indices(selected, 100, 10)
+    inner = selected[(selected > 0) & (selected < 99)]
+    assert np.all(np.isfinite(values[inner]))
+
+
+def test_get_decimator():
+    assert get_decimator() is lttb
+    assert get_decimator("minmax") is minmax
+    assert get_decimator("none") is None
+    with pytest.raises(ValueError):
+        get_decimator("unknown")
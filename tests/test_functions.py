@@ -0,0 +1,199 @@
+"""Tests for the functions applied to history data"""
+import numpy as np
+import pytest
+from metricq.history_client import HistoryResponse
+from metricq.history_pb2 import HistoryResponse as HistoryResponseProto
+from metricq.types import Timedelta
+
+from metricq_grafana.functions import MovingAverageFunction
+from metricq_grafana.history_data import HistoryData
+
+START_NS = 1_600_000_000 * 10**9
+
+
+def _aggregate_response(durations, active_times, integrals):
+    """Aggregates ending after the given durations, the first one at START_NS"""
+    proto = HistoryResponseProto()
+    proto.time_delta.extend([START_NS] + list(durations[1:]))
+    for active_time, integral in zip(active_times, integrals):
+        aggregate = proto.aggregate.add()
+        if active_time:
+            aggregate.minimum = aggregate.maximum = aggregate.sum = 1.0
+            aggregate.count = 1
+            aggregate.active_time = active_time
+            aggregate.integral = integral
+    return HistoryResponse(proto, request_duration=0.0)
+
+
+def _value_response(durations, values):
+    proto = HistoryResponseProto()
+    proto.time_delta.extend([START_NS] + list(durations[1:]))
+    proto.value.extend(values)
+    return HistoryResponse(proto, request_duration=0.0)
+
+
+def _random_response(rng, count, interval_ns, values=False):
+    durations = rng.integers(interval_ns // 2, interval_ns * 2, size=count).tolist()
+    if values:
+        return _value_response(durations, rng.normal(100, 20, size=count).tolist())
+    active = rng.random(size=count) >= rng.random()
+    active_times = np.where(active, durations, 0).tolist()
+    means = rng.normal(100, 20, size=count)
+    return _aggregate_response(durations, active_times, (means * active_times).tolist())
+
+
+def _previous_moving_average(response, interval):
+    """The previous implementation, a running window over TimeAggregates.
+
+    Yields the timestamp, the value and the active time of each window.
+    """
+    response_aggregates = list(response.aggregates(convert=True))
+    if len(response_aggregates) == 0:
+        return
+
+    interval_durations = [Timedelta(0)] + [
+        current.timestamp - previous.timestamp
+        for previous, current in zip(response_aggregates, response_aggregates[1:])
+    ]
+    ma_integral_ns = 0
+    ma_active_time = Timedelta(0)
+    ma_begin_index = 1
+    ma_begin_time = response_aggregates[0].timestamp
+    ma_end_index = 1
+    ma_end_time = response_aggregates[0].timestamp
+
+    for timeaggregate, current_interval_duration in zip(
+        response_aggregates, interval_durations
+    ):
+        outside_duration = max(Timedelta(0), interval - current_interval_duration)
+        seek_begin_time = (
+            timeaggregate.timestamp - current_interval_duration - outside_duration / 2
+        )
+        seek_end_time = timeaggregate.timestamp + outside_duration / 2
+
+        while ma_begin_time < seek_begin_time:
+            next_step_time = min(
+                response_aggregates[ma_begin_index].timestamp, seek_begin_time
+            )
+            step_duration = next_step_time - ma_begin_time
+            scale = step_duration.ns / interval_durations[ma_begin_index].ns
+            ma_active_time -= response_aggregates[ma_begin_index].active_time * scale
+            ma_integral_ns -= response_aggregates[ma_begin_index].integral_ns * scale
+            ma_begin_time = next_step_time
+            if ma_begin_time == response_aggregates[ma_begin_index].timestamp:
+                ma_begin_index += 1
+
+        while ma_end_time < seek_end_time and ma_end_index < len(response_aggregates):
+            next_step_time = min(
+                response_aggregates[ma_end_index].timestamp, seek_end_time
+            )
+            step_duration = next_step_time - ma_end_time
+            scale = step_duration.ns / interval_durations[ma_end_index].ns
+            ma_active_time += response_aggregates[ma_end_index].active_time * scale
+            ma_integral_ns += response_aggregates[ma_end_index].integral_ns * scale
+            ma_end_time = next_step_time
+            if ma_end_time == response_aggregates[ma_end_index].timestamp:
+                ma_end_index += 1
+
+        if seek_begin_time != ma_begin_time or seek_end_time != ma_end_time:
+            continue
+        # Compared with 0 before, which a Timedelta never equals, dividing by zero
+        if ma_active_time.ns == 0:
+            continue
+
+        yield timeaggregate.timestamp.posix_ns, ma_integral_ns / ma_active_time.ns, (
+            ma_active_time.ns
+        )
+
+
+def _moving_average(response, interval):
+    return MovingAverageFunction(interval).transform_data(
+        HistoryData.from_response(response)
+    )
+
+
+@pytest.mark.parametrize("values", [False, True])
+@pytest.mark.parametrize("seed", range(50))
+def test_moving_average_matches_previous(seed, values):
+    """Equal to the previous implementation, except for the intended differences:
+
+    * The previous one truncated the active time to whole nanoseconds in every
+      step, hence the tolerance.
+    * Windows without active time are skipped. The previous one divided by zero,
+      or yielded a value from the residue of its truncated running sums.
+    """
+    rng = np.random.default_rng(seed)
+    interval_ns = int(rng.integers(1, 10**10))
+    response = _random_response(rng, int(rng.integers(0, 500)), interval_ns, values)
+    window = Timedelta(int(rng.integers(0, 100 * interval_ns)))
+
+    timestamps, result = _moving_average(response, window)
+
+    previous = {
+        timestamp: (value, active_time)
+        for timestamp, value, active_time in _previous_moving_average(response, window)
+    }
+    assert set(timestamps.tolist()) <= previous.keys()
+    for timestamp in previous.keys() - set(timestamps.tolist()):
+        assert abs(previous[timestamp][1]) < 1e-6 * max(window.ns, 1)
+    np.testing.assert_allclose(
+        result, [previous[timestamp][0] for timestamp in timestamps.tolist()], rtol=1e-6
+    )
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_moving_average_identical_for_whole_intervals(seed):
+    """Identical if windows only cover whole intervals, nothing is truncated then"""
+    rng = np.random.default_rng(seed)
+    interval_ns = 10**9
+    count = 200
+    response = _aggregate_response(
+        [interval_ns] * count,
+        [interval_ns] * count,
+        (rng.integers(0, 200, size=count) * interval_ns).tolist(),
+    )
+    window = Timedelta(int(rng.integers(0, 20)) * 2 * interval_ns + interval_ns)
+
+    timestamps, result = _moving_average(response, window)
+
+    previous = list(_previous_moving_average(response, window))
+    np.testing.assert_array_equal(timestamps, [timestamp for timestamp, *_ in previous])
+    np.testing.assert_array_equal(result, [value for _, value, _ in previous])
+
+
+def test_moving_average_skips_windows_without_active_time():
+    interval_ns = 10**9
+    active = [True] * 10 + [False] * 10 + [True] * 10
+    active_times = [interval_ns if value else 0 for value in active]
+    response = _aggregate_response(
+        [interval_ns] * len(active),
+        active_times,
+        [2.0 * active_time for active_time in active_times],
+    )
+    window = Timedelta(3 * interval_ns)
+
+    timestamps, result = _moving_average(response, window)
+
+    index = (timestamps - START_NS) // interval_ns
+    # The window of interval i covers the intervals i - 1 to i + 1
+    assert index.tolist() == [*range(2, 11), *range(19, 29)]
+    np.testing.assert_array_equal(result, 2.0)
+
+
+def test_moving_average_does_not_truncate_active_time():
+    # Windows cover 1 ns of each neighbour, i.e. 5 / 7 ns of its active time
+    duration, active_time = 7, 5
+    integrals = [1.0, 2.0, 3.0, 4.0, 5.0, 6.0]
+    response = _aggregate_response(
+        [duration] * len(integrals), [active_time] * len(integrals), integrals
+    )
+
+    timestamps, result = _moving_average(response, Timedelta(duration + 2))
+
+    assert ((timestamps - START_NS) // duration).tolist() == [2, 3, 4]
+    expected = [
+        (integrals[i] + (integrals[i - 1] + integrals[i + 1]) / duration)
+        / (active_time + 2 * active_time / duration)
+        for i in (2, 3, 4)
+    ]
+    np.testing.assert_allclose(result, expected, rtol=1e-12)
@@ -0,0 +1,149 @@
+"""Tests for the scheduling of requests to the database"""
+import asyncio
+
+from metricq_grafana.request_context import (
+    PRIORITY_BACKGROUND,
+    PRIORITY_INTERACTIVE,
+    RequestContext,
+    current_request,
+)
+from metricq_grafana.scheduler import RequestScheduler
+
+
+async def _request(scheduler, log, name, client="a", priority=PRIORITY_INTERACTIVE):
+    current_request.set(RequestContext("/query", client, priority))
+    async with scheduler.slot():
+        log.append(name)
+        await asyncio.sleep(0)
+
+
+async def _blocked(scheduler, *requests):
+    """Runs the requests while all slots are taken, returns the order served"""
+    log = []
+    release = asyncio.Event()
+
+    async def hold():
+        async with scheduler.slot():
+            await release.wait()
+
+    holders = [asyncio.create_task(hold()) for _ in range(scheduler._concurrency)]
+    await asyncio.sleep(0)
+    tasks = []
+    for args in requests:
+        tasks.append(asyncio.create_task(_request(scheduler, log, *args)))
+        await asyncio.sleep(0)
+    release.set()
+    await asyncio.gather(*holders, *tasks)
+    return log
+
+
+def test_slots_are_limited():
+    async def main():
+        scheduler = RequestScheduler(2)
+        running = 0
+        most = 0
+
+        async def request():
+            nonlocal running, most
+            async with scheduler.slot():
+                running += 1
+                most = max(most, running)
+                await asyncio.sleep(0.001)
+                running -= 1
+
+        await asyncio.gather(*(request() for _ in range(10)))
+        assert most == 2
+        assert scheduler.active == 0
+        assert scheduler.queue_depth == 0
+
+    asyncio.run(main())
+
+
+def test_clients_take_turns():
+    async def main():
+        scheduler = RequestScheduler(1)
+        log = await _blocked(
+            scheduler,
+            ("a1", "a"),
+            ("a2", "a"),
+            ("a3", "a"),
+            ("b1", "b"),
+            ("c1", "c"),
+        )
+        assert log == ["a1", "b1", "c1", "a2", "a3"]
+
+    asyncio.run(main())
+
+
+def test_priorities_are_served_first():
+    async def main():
+        scheduler = RequestScheduler(1)
+        log = await _blocked(
+            scheduler,
+            ("background", "a", PRIORITY_BACKGROUND),
+            ("interactive", "b", PRIORITY_INTERACTIVE),
+        )
+        assert log == ["interactive", "background"]
+
+    asyncio.run(main())
+
+
+def test_cancelled_waiter_leaves_queue():
+    async def main():
+        scheduler = RequestScheduler(1)
+        release = asyncio.Event()
+        log = []
+
+        async def hold():
+            async with scheduler.slot():
+                await release.wait()
+
+        holder = asyncio.create_task(hold())
+        await asyncio.sleep(0)
+        waiter = asyncio.create_task(_request(scheduler, log, "cancelled"))
+        await asyncio.sleep(0)
+        assert scheduler.queue_depth == 1
+
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+        assert scheduler.queue_depth == 0
+
+        release.set()
+        await holder
+        assert scheduler.active == 0
+        assert log == []
+
+    asyncio.run(main())
+
+
+def test_waiter_cancelled_while_slot_is_released():
+    async def main():
+        scheduler = RequestScheduler(1)
+        release = asyncio.Event()
+        log = []
+
+        async def hold():
+            async with scheduler.slot():
+                await release.wait()
+                # Cancelled before it can remove itself from the queue
+                waiter.cancel()
+
+        holder = asyncio.create_task(hold())
+        await asyncio.sleep(0)
+        waiter = asyncio.create_task(_request(scheduler, log, "cancelled"))
+        other = asyncio.create_task(_request(scheduler, log, "other", client="b"))
+        await asyncio.sleep(0)
+
+        release.set()
+        await holder
+        await asyncio.gather(waiter, other, return_exceptions=True)
+        assert waiter.cancelled()
+        assert log == ["other"]
+        assert scheduler.active == 0
+        assert scheduler.queue_depth == 0
+
+        # No slot leaked
+        await asyncio.wait_for(_request(scheduler, log, "later"), timeout=1)
+        assert log == ["other", "later"]
+
+    asyncio.run(main())